@@ -0,0 +1,267 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    #not available on Windows, peak RSS is reported as null there
+    resource = None
+
+
+#(width, height) of the cameras the booths run with
+CAMERA_RESOLUTIONS = {
+    "dslr_24mp": (6000, 4000),
+    "dslr_18mp": (5184, 3456),
+    "webcam_1080p": (1920, 1080),
+}
+
+BENCHMARK_CONFIG = """
+IMG_SRC_BASE_DIR: {work_dir}/src
+IMG_RESULT_BASE_DIR: {work_dir}/res
+IMG_FRAME_BASE_DIR: {repo_dir}/frame
+IMG_FRAME_ASSETS_DIR: {repo_dir}/static/frame_assets
+CASCADE_CLASSIFIER_XML: {repo_dir}/haarcascade_frontalface_alt.xml
+EMAIL_USERNAME: benchmark@localhost
+EMAIL_PASSWD: benchmark
+AVAILABLE_EFFECT: [original, light_original, light_grayscale, dark_grayscale, sepia, summer, winter]
+AVAILABLE_8_FRAME: {frames}
+AVAILABLE_8_FRAME_ELLIPSE: []
+AVAILABLE_6_FRAME: []
+AVAILABLE_6_FRAME_6_TAKES: []
+SMTP_SERVERNAME: localhost
+SMTP_SERVERPORT: 25
+PRINTER_NAME: null
+HOTFOLDER_PATH_PRINT: {work_dir}/hotfolder
+EMAIL_OUTBOX_PATH: {work_dir}/email_outbox.db
+"""
+
+
+def repo_dir():
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def list_frames():
+    return sorted(os.path.basename(x) for x in glob.glob(os.path.join(repo_dir(), "frame", "frame-*.png")))
+
+
+def write_benchmark_config(work_dir):
+    #never touch a deployment config, the benchmark runs against a generated one.
+    #which family a frame belongs to is deployment config, every bundled frame is
+    #benchmarked with the 8-frame layout, the cost barely depends on the layout
+    config_path = os.path.join(work_dir, "config.yaml")
+    with open(config_path, "w") as f:
+        f.write(BENCHMARK_CONFIG.format(work_dir=work_dir, repo_dir=repo_dir(), frames=json.dumps(list_frames())))
+    os.environ["CONFIG_PATH"] = config_path
+    return config_path
+
+
+def parse_resolution(value):
+    if value in CAMERA_RESOLUTIONS:
+        return value, CAMERA_RESOLUTIONS[value]
+    width, height = value.lower().split("x")
+    return value, (int(width), int(height))
+
+
+def synthetic_capture(width, height, seed):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    gradient = np.dstack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)])
+    noise = rng.integers(0, 48, (height, width, 3))
+    return np.clip(gradient + noise, 0, 255).astype(np.uint8)
+
+
+def measure(fn, inputs, repeat):
+    #one sample per call, every input is run repeat times
+    samples = []
+    for _ in range(repeat):
+        for x in inputs:
+            start = time.perf_counter()
+            fn(x)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def latency_stats(samples):
+    return {
+        "samples": len(samples),
+        "p50_ms": round(float(np.percentile(samples, 50)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(samples, 95)) * 1000, 2),
+        "mean_ms": round(float(np.mean(samples)) * 1000, 2),
+        "per_second": round(1.0 / float(np.percentile(samples, 50)), 2),
+    }
+
+
+def peak_rss_mb():
+    #of the calling process. RUSAGE_CHILDREN would report the server's RSS at the time the
+    #workers were forked, and ru_maxrss survives the exec of a spawned worker, so on Linux
+    #the peak comes from VmHWM, which starts over with the new process image
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except FileNotFoundError:
+        pass
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(usage.ru_maxrss / scale, 1)
+
+
+def benchmark_effects(image_processing, captures, repeat):
+    return {
+        name: latency_stats(measure(effect, captures, repeat))
+        for name, effect in image_processing.EFFECTS.items()
+    }
+
+
+def benchmark_crops(image_processing, captures, repeat):
+    #the 8-frame slot, the crop that runs once per capture before the effects
+    slot_size = image_processing.FRAME_LAYOUTS["AVAILABLE_8_FRAME"]["slot_size"]
+    crops = {
+        "center_crop": lambda capture: image_processing.resize_image(capture, slot_size),
+        "face_detect": image_processing.find_faces,
+        "face_aware_crop": lambda capture: image_processing.resize_image(capture, slot_size, image_processing.find_faces(capture)),
+    }
+    return { name: latency_stats(measure(crop, captures, repeat)) for name, crop in crops.items() }
+
+
+def benchmark_frames(image_processing, captures, repeat, frame_dir):
+    #compile_frame gets slot-sized captures, as it does in the pipeline
+    results = {}
+    for frame_name in list_frames():
+        frame_id = frame_name[len("frame-"):-len(".png")]
+        slot_size = image_processing.get_slot_size(frame_dir, frame_name)
+        images = [ image_processing.resize_image(x, slot_size) for x in captures ]
+        results[frame_name] = latency_stats(measure(
+            lambda images: image_processing.compile_frame(frame_id, None, frame_dir, images=images),
+            [images],
+            repeat
+        ))
+    return results
+
+
+def benchmark_animations(image_processing, captures, repeat, work_dir):
+    slot_size = image_processing.FRAME_LAYOUTS["AVAILABLE_8_FRAME"]["slot_size"]
+    images = [ image_processing.resize_image(x, slot_size) for x in captures ]
+    out_gif = os.path.join(work_dir, "benchmark.gif")
+    return {
+        "generate_gif": latency_stats(measure(
+            lambda images: image_processing.generate_gif(images, out_gif, delay=0.7),
+            [images],
+            repeat
+        ))
+    }
+
+
+def benchmark_end_to_end(app, image_processing, captures, sessions, work_dir, name):
+    #full sessions through /api/generate-image, the first one warms the worker pool up
+    src_dir = os.path.join(work_dir, "src")
+    template_dir = os.path.join(work_dir, f"captures-{name}")
+    os.makedirs(template_dir, exist_ok=True)
+    for i, capture in enumerate(captures):
+        image_processing.save_image(capture, os.path.join(template_dir, f"{i + 1}.jpg"))
+
+    frame_id = list_frames()[0][len("frame-"):-len(".png")]
+    client = app.test_client()
+    samples = []
+    for session in range(sessions + 1):
+        tx_id = f"benchmark-{name}-{session}"
+        shutil.copytree(template_dir, os.path.join(src_dir, tx_id))
+        start = time.perf_counter()
+        response = client.post("/api/generate-image", json={"tx_id": tx_id, "frame_id": frame_id})
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"Session {tx_id} failed: {response.get_json()}")
+        if session > 0:
+            samples.append(elapsed)
+
+    stats = latency_stats(samples)
+    stats["sessions_per_minute"] = round(60.0 / float(np.percentile(samples, 50)), 2)
+    return stats
+
+
+def environment_info():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir(), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    import cv2
+    import PIL
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "pillow": PIL.__version__,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the photobooth effect pipeline")
+    parser.add_argument("--resolution", action="append", help=f"camera resolution, one of {', '.join(CAMERA_RESOLUTIONS)} or WIDTHxHEIGHT (repeatable, default: dslr_18mp)")
+    parser.add_argument("--batch", type=int, default=8, help="captures per session")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every micro benchmark")
+    parser.add_argument("--sessions", type=int, default=3, help="end-to-end sessions per resolution, after one warm-up session")
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+    if args.batch < 8:
+        parser.error("--batch must be at least 8, the frames are benchmarked with the 8-frame layout")
+
+    resolutions = [ parse_resolution(x) for x in (args.resolution or ["dslr_18mp"]) ]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        write_benchmark_config(work_dir)
+        import image_processing
+        import pipeline
+        from main import app
+
+        frame_dir = app.config["IMG_FRAME_BASE_DIR"]
+        results = {
+            "environment": environment_info(),
+            "batch": args.batch,
+            "repeat": args.repeat,
+            "resolutions": {},
+        }
+        for name, (width, height) in resolutions:
+            print(f"Benchmarking {name} ({width}x{height})...", file=sys.stderr)
+            captures = [ synthetic_capture(width, height, seed) for seed in range(args.batch) ]
+            result = {
+                "size": [width, height],
+                "effects": benchmark_effects(image_processing, captures, args.repeat),
+                "crops": benchmark_crops(image_processing, captures, args.repeat),
+                "frames": benchmark_frames(image_processing, captures, args.repeat, frame_dir),
+                "animations": benchmark_animations(image_processing, captures, args.repeat, work_dir),
+            }
+            if not args.skip_end_to_end:
+                result["end_to_end"] = benchmark_end_to_end(app, image_processing, captures, args.sessions, work_dir, name)
+            result["peak_rss_mb"] = peak_rss_mb()
+            results["resolutions"][name] = result
+
+        workers = sorted(x for x in pipeline.on_every_worker(peak_rss_mb).values() if x is not None)
+        pipeline.shutdown_worker_pool()
+        results["peak_rss_mb"] = {"server": peak_rss_mb(), "workers": workers or None}
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import threading
+from flask import g, jsonify, request
+from config import app
+
+#endpoints that share a limit; everything else, frames, job status and the static
+#files, is never limited so a burst of generates cannot starve the gallery
+ENDPOINT_GROUPS = {
+    "generate_image_api": "generate",
+    "generate_image_stream_api": "generate",
+    "upload_image_api": "upload",
+    "send_email_api": "email",
+    "print_image_api": "print",
+}
+
+#concurrent requests per group, generate is bounded by the worker pool anyway
+DEFAULT_LIMITS = {
+    "generate": 2,
+    "upload": 4,
+    "email": 4,
+    "print": 4,
+}
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limits):
+        #a limit of 0 turns the group's limit off
+        self.semaphores = { group: threading.BoundedSemaphore(limit) for group, limit in limits.items() if limit }
+        self.active = 0
+        self.draining = False
+        self.idle = threading.Condition()
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+    def reject(self, message, retry_after):
+        data = {
+            "status_code": 503,
+            "message": "Server busy",
+            "error": message
+        }
+        response = jsonify(data)
+        response.status_code = 503
+        response.headers["Retry-After"] = str(retry_after)
+        return response
+
+    def before_request(self):
+        group = ENDPOINT_GROUPS.get(request.endpoint)
+        #while draining, results can still be fetched but no new work is accepted
+        if self.draining and (group is not None or request.method == "POST"):
+            return self.reject("Server is shutting down", 30)
+
+        #full means busy right now, waiting would only tie up another server thread
+        semaphore = self.semaphores.get(group)
+        if semaphore is not None and not semaphore.acquire(blocking=False):
+            return self.reject(f"Too many concurrent {group} requests", 1)
+        g.concurrency_group = group if semaphore is not None else None
+        with self.idle:
+            self.active += 1
+        g.concurrency_active = True
+
+    def release(self, group, active):
+        if group is not None:
+            self.semaphores[group].release()
+        if active:
+            with self.idle:
+                self.active -= 1
+                self.idle.notify_all()
+
+    def after_request(self, response):
+        #a streamed response keeps its slot until the server has sent the last event
+        if response.is_streamed:
+            group, active = g.pop("concurrency_group", None), g.pop("concurrency_active", False)
+            response.call_on_close(lambda: self.release(group, active))
+        return response
+
+    def teardown_request(self, exc):
+        self.release(g.pop("concurrency_group", None), g.pop("concurrency_active", False))
+
+    def drain(self, timeout):
+        #refuse new work and wait for the requests in flight
+        self.draining = True
+        with self.idle:
+            return self.idle.wait_for(lambda: self.active == 0, timeout)
+
+
+limiter = ConcurrencyLimiter({**DEFAULT_LIMITS, **app.config["CONCURRENCY_LIMITS"]})
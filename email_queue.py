@@ -0,0 +1,180 @@
+import json
+import time
+import uuid
+import sqlite3
+import smtplib
+import logging
+import threading
+from config import app
+from metrics import timed
+from send_email import compose_email, open_smtp
+
+
+class EmailOutbox:
+    #messages are persisted before they are acknowledged, so a restart resumes the queue.
+    #only the compose parameters are stored, the MIME message is built by the worker
+    def __init__(self, db_path, worker_count, max_attempts, retry_delay):
+        self.worker_count = worker_count
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.workers = []
+        self.db_path = db_path
+        self.db = None
+
+    def open_db(self):
+        #only the serving process opens the outbox; importing this module, e.g. from a
+        #pool worker or regenerate.py, must not touch messages a live worker is sending
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                recipients TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL
+            )
+        """)
+        #anything that was mid-send when the process stopped is sent again
+        db.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'")
+        db.commit()
+        return db
+
+    def start(self):
+        with self.lock:
+            if self.db is not None:
+                return
+            self.db = self.open_db()
+            for i in range(self.worker_count):
+                worker = threading.Thread(target=self.run_worker, name=f"email-worker-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def enqueue(self, recipients, payload):
+        self.start()
+        email_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO outbox (id, recipients, payload, status, created_at, updated_at, next_attempt_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (email_id, json.dumps(recipients), json.dumps(payload), now, now, now)
+            )
+            self.db.commit()
+            self.wakeup.notify()
+        return email_id
+
+    def get(self, email_id):
+        self.start()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, recipients, status, attempts, last_error, created_at, updated_at FROM outbox WHERE id = ?",
+                (email_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "email_id": row[0],
+            "recipients": json.loads(row[1]),
+            "status": row[2],
+            "attempts": row[3],
+            "last_error": row[4],
+            "created_at": row[5],
+            "updated_at": row[6]
+        }
+
+    def claim(self, timeout):
+        #take the oldest message that is due, or wait until one might be
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, recipients, payload, attempts FROM outbox WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY created_at LIMIT 1",
+                (time.time(),)
+            ).fetchone()
+            if row is None:
+                self.wakeup.wait(timeout)
+                return None
+            claimed = self.db.execute(
+                "UPDATE outbox SET status = 'sending', updated_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), row[0])
+            ).rowcount
+            self.db.commit()
+        if not claimed:
+            return None
+        return row[0], json.loads(row[1]), json.loads(row[2]), row[3]
+
+    def finish(self, email_id, attempts, error=None, permanent=False):
+        now = time.time()
+        if error is None:
+            status, next_attempt_at = "sent", now
+        elif permanent or attempts >= self.max_attempts:
+            status, next_attempt_at = "failed", now
+        else:
+            status, next_attempt_at = "queued", now + self.retry_delay * 2 ** (attempts - 1)
+        with self.lock:
+            self.db.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, last_error = ?, updated_at = ?, next_attempt_at = ? WHERE id = ?",
+                (status, attempts, error, now, next_attempt_at, email_id)
+            )
+            self.db.commit()
+        return status
+
+    def run_worker(self):
+        #each worker keeps one authenticated connection open between messages
+        smtp = None
+        while True:
+            claimed = self.claim(timeout=1.0)
+            if claimed is None:
+                continue
+            email_id, recipients, payload, attempts = claimed
+            attempts += 1
+            try:
+                #attachments come pre-encoded from the cache, send_message serializes once
+                message = compose_email(payload["recipient_name"], recipients, payload["tx_id"], payload["effect"])
+                with timed("smtp_send", effect=payload["effect"]):
+                    try:
+                        if smtp is None:
+                            smtp = open_smtp(app.config['SMTP_SERVERNAME'], app.config['SMTP_SERVERPORT'])
+                        smtp.send_message(message, app.config['EMAIL_USERNAME'], recipients)
+                    except (smtplib.SMTPServerDisconnected, ConnectionError):
+                        #the server dropped an idle connection, reconnect once and resend
+                        if smtp is not None:
+                            close_smtp(smtp)
+                            smtp = None
+                        smtp = open_smtp(app.config['SMTP_SERVERNAME'], app.config['SMTP_SERVERPORT'])
+                        smtp.send_message(message, app.config['EMAIL_USERNAME'], recipients)
+                self.finish(email_id, attempts)
+            except Exception as e:
+                status = self.finish(email_id, attempts, f"{e}", is_permanent(e))
+                logging.error(f"Error sending email {email_id} (attempt {attempts}, now {status}): {e}", exc_info=True)
+                #SMTP replies leave the session usable, anything else means a broken connection
+                broken = not isinstance(e, smtplib.SMTPException) or isinstance(e, smtplib.SMTPServerDisconnected)
+                if broken and smtp is not None:
+                    close_smtp(smtp)
+                    smtp = None
+
+
+def is_permanent(e):
+    #a 5xx reply will not get better by retrying, a 4xx one (greylisting, a busy
+    #mailbox) usually does
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in e.recipients.values())
+    return isinstance(e, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)) and e.smtp_code >= 500
+
+
+def close_smtp(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        smtp.close()
+
+
+email_outbox = EmailOutbox(
+    app.config["EMAIL_OUTBOX_PATH"],
+    app.config["EMAIL_WORKERS"],
+    app.config["EMAIL_MAX_ATTEMPTS"],
+    app.config["EMAIL_RETRY_DELAY"]
+)
@@ -1,14 +1,14 @@
 import os
+import json
+import logging
+from collections import namedtuple
+from functools import lru_cache
 import cv2
-import imageio
 import numpy as np
-from config import app
-from PIL import Image
-from scipy.interpolate import UnivariateSpline
-
-from fimage import FImage
-from fimage.filters import *
-from fimage.presets import Preset
+from PIL import Image, ImageCms
+from settings import settings
+from metrics import timed
+from presets import *
 
 
 
@@ -48,14 +48,65 @@ def load_image(img_path, transparent=False):
   return img
 
 
-def save_image(np_img, save_path):
-  cv2.imwrite(save_path, np_img)
+#cv2.imwrite options of the effect captures, quality only matters for the lossy formats
+def intermediate_params(save_path):
+  ext = os.path.splitext(save_path)[1].lower()
+  if ext in [".jpg", ".jpeg"]:
+    return [cv2.IMWRITE_JPEG_QUALITY, settings["INTERMEDIATE_QUALITY"]]
+  if ext == ".webp":
+    return [cv2.IMWRITE_WEBP_QUALITY, settings["INTERMEDIATE_QUALITY"]]
+  return []
+
+
+def temp_path(path):
+  #a dot file in the same directory, renamed over path once complete. Readers skip dot
+  #files and storage cleans up the ones a crash left behind; the extension is kept, the
+  #mp4 writer picks its container by it
+  name, ext = os.path.splitext(os.path.basename(path))
+  return os.path.join(os.path.dirname(path), f".{name}.{os.getpid()}.tmp{ext}")
+
+
+def save_image(np_img, save_path, params=None):
+  #encoded in memory and renamed into place, a reader never sees a half-written file
+  ok, buffer = cv2.imencode(os.path.splitext(save_path)[1], np_img, params or [])
+  if not ok:
+    raise ValueError(f"Cannot encode {save_path}")
+  tmp_path = temp_path(save_path)
+  with open(tmp_path, "wb") as f:
+    f.write(buffer.tobytes())
+  os.replace(tmp_path, save_path)
+
+
+def capture_name(img_file):
+  #effect captures keep the source name, or take the INTERMEDIATE_FORMAT extension
+  if settings["INTERMEDIATE_FORMAT"] is None:
+    return img_file
+  return f"{os.path.splitext(img_file)[0]}.{settings['INTERMEDIATE_FORMAT']}"
+
 
+def face_span(faces, axis):
+  #union of the face boxes along one axis, vertically with headroom for the hair
+  if axis == 0:
+    return min(x for x, y, w, h in faces), max(x + w for x, y, w, h in faces)
+  return min(y - 0.4 * h for x, y, w, h in faces), max(y + h for x, y, w, h in faces)
 
-def resize_image(np_img, new_size):
-  image  = Image.fromarray(np_img)
-  width  = image.size[0]
-  height = image.size[1]
+
+def crop_offset(length, new_length, faces, axis):
+  #centre crop, or centred on the faces when there are any
+  offset = (length - new_length) // 2
+  if faces:
+    start, end = face_span(faces, axis)
+    if end - start <= new_length:
+      offset = int((start + end - new_length) / 2)
+    else:
+      #the faces don't fit, keep the top of the heads
+      offset = int(start)
+  return min(max(offset, 0), length - new_length)
+
+
+def crop_rect(shape, new_size, faces=None):
+  height = shape[0]
+  width = shape[1]
 
   aspect = width / float(height)
 
@@ -66,86 +117,113 @@ def resize_image(np_img, new_size):
   if aspect > ideal_aspect:
       #crop the left and right edges:
       new_width = int(ideal_aspect * height)
-      offset = (width - new_width) / 2
-      resize = (offset, 0, width - offset, height)
+      offset = crop_offset(width, new_width, faces, 0)
+      return (offset, 0, offset + new_width, height)
   else:
       # crop the top and bottom:
       new_height = int(width / ideal_aspect)
-      offset = (height - new_height) / 2
-      resize = (0, offset, width, height - offset)
+      offset = crop_offset(height, new_height, faces, 1)
+      return (0, offset, width, offset + new_height)
+
 
-  result = image.crop(resize).resize((ideal_width, ideal_height), Image.ANTIALIAS)
-  result = np.asarray(result)
+def resize_image(np_img, new_size, faces=None):
+  if np_img.shape[1] == new_size[0] and np_img.shape[0] == new_size[1]:
+    return np_img
+
+  left, top, right, bottom = crop_rect(np_img.shape, new_size, faces)
+  result = cv2.resize(np_img[top:bottom, left:right], (new_size[0], new_size[1]), interpolation=cv2.INTER_AREA)
   return result
 
 
 def lookuptable(x, y):
+  #scipy takes longer to import than the rest of the pipeline, only the LUTs need it
+  from scipy.interpolate import UnivariateSpline
   spline = UnivariateSpline(x,y)
-  return spline(range(256))
+  return np.clip(spline(range(256)), 0, 255).astype(np.uint8)
+
+
+def channel_lookuptable(blue, green, red):
+  #one 3-channel LUT so cv2.LUT maps the whole BGR image in a single pass
+  return np.dstack([blue, green, red]).reshape(1, 256, 3)
+
 
+@lru_cache(maxsize=1)
+def get_kernels():
+  #effect kernels are built on first use and shared by every effect call
+  kernels = {}
+  kernels["increase_lut"] = lookuptable([0, 64, 128, 256], [0, 80, 160, 256])
+  kernels["decrease_lut"] = lookuptable([0, 64, 128, 256], [0, 50, 100, 256])
+  kernels["identity_lut"] = np.arange(256, dtype=np.uint8)
+  kernels["summer_lut"] = channel_lookuptable(kernels["decrease_lut"], kernels["identity_lut"], kernels["increase_lut"])
+  kernels["winter_lut"] = channel_lookuptable(kernels["increase_lut"], kernels["identity_lut"], kernels["decrease_lut"])
+  kernels["sepia_matrix"] = np.array([[0.272, 0.534, 0.131],
+                                      [0.349, 0.686, 0.168],
+                                      [0.393, 0.769, 0.189]], dtype=np.float32)
+  return kernels
 
-def detect_face(img, cascade_classifier):
-  grayscale = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-  face_rects = cascade_classifier.detectMultiScale(grayscale, scaleFactor=1.1, minNeighbors=4)
-  return face_rects
 
+@lru_cache(maxsize=1)
+def get_cascade_classifier():
+  #parsed once per process, the XML takes longer to load than a detection
+  return load_cascade_classifier(settings["CASCADE_CLASSIFIER_XML"])
 
-def apply_beauty_filter(img_path):
-  img = FImage(img_path)
-  img.apply(BeautyFilter)
-  img.save(img_path)
 
-  np_img = load_image(img_path)
+def detect_face(img, cascade_classifier, max_size=480):
+  #detect on a small grayscale copy, then scale the boxes back to the full image.
+  #bilinear is plenty for the detector and an order of magnitude cheaper than INTER_AREA
+  scale = min(1.0, max_size / float(max(img.shape[:2])))
+  if scale < 1.0:
+    img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+  grayscale = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+  grayscale = cv2.equalizeHist(grayscale)
+  face_rects = cascade_classifier.detectMultiScale(grayscale, scaleFactor=1.1, minNeighbors=4, minSize=(32, 32))
+  return [ [int(round(x / scale)) for x in rect] for rect in face_rects ]
+
+
+def find_faces(np_img):
+  #OpenCV 5 moved the Haar cascades out of the main package, fall back to a centre crop
+  if not settings["FACE_AWARE_CROP"] or not hasattr(cv2, "CascadeClassifier"):
+    return []
+  return detect_face(np_img, get_cascade_classifier(), settings["FACE_DETECT_SIZE"])
+
+
+def apply_preset(np_img, preset):
+  return preset.process(np_img)
+
+
+def apply_original_effect(np_img):
   return np_img
 
 
-def apply_light_grayscale_effect(img_path):
-  img = FImage(img_path)
-  img.apply(LightenFilter)
-  img.save(img_path)
-  
-  np_img = load_image(img_path)
-  light_grayscale = cv2.cvtColor(np_img, cv2.COLOR_BGR2GRAY)
+def apply_beauty_filter(np_img):
+  return apply_preset(np_img, BeautyFilter)
+
+
+def apply_light_grayscale_effect(np_img):
+  light = apply_preset(np_img, LightenFilter)
+  light_grayscale = cv2.cvtColor(light, cv2.COLOR_BGR2GRAY)
   return light_grayscale
 
 
-def apply_dark_grayscale_effect(img_path):
-  img = FImage(img_path)
-  img.apply(DarkenFilter)
-  img.save(img_path)
-  
-  np_img = load_image(img_path)
-  dark_grayscale = cv2.cvtColor(np_img, cv2.COLOR_BGR2GRAY)
+def apply_dark_grayscale_effect(np_img):
+  dark = apply_preset(np_img, DarkenFilter)
+  dark_grayscale = cv2.cvtColor(dark, cv2.COLOR_BGR2GRAY)
   return dark_grayscale
 
 
 def apply_sepia_effect(np_img):
-  sepia = np.array(np_img, dtype=np.float64)
-  sepia = cv2.transform(sepia, np.matrix([[0.272, 0.534, 0.131],
-                                  [0.349, 0.686, 0.168],
-                                  [0.393, 0.769, 0.189]]))
-  sepia[np.where(sepia > 255)] = 255
-  sepia = np.array(sepia, dtype=np.uint8)
+  #uint8 in, uint8 out: cv2 runs the matrix in fixed point and saturates at 255
+  sepia = cv2.transform(np_img, get_kernels()["sepia_matrix"])
   return sepia
 
 
 def apply_summer_effect(np_img):
-  increaseLookupTable = lookuptable([0, 64, 128, 256], [0, 80, 160, 256])
-  decreaseLookupTable = lookuptable([0, 64, 128, 256], [0, 50, 100, 256])
-  blue_channel, green_channel, red_channel  = cv2.split(np_img)
-  red_channel = cv2.LUT(red_channel, increaseLookupTable).astype(np.uint8)
-  blue_channel = cv2.LUT(blue_channel, decreaseLookupTable).astype(np.uint8)
-  summer= cv2.merge((blue_channel, green_channel, red_channel))
+  summer = cv2.LUT(np_img, get_kernels()["summer_lut"])
   return summer
 
 
 def apply_winter_effect(np_img):
-  increaseLookupTable = lookuptable([0, 64, 128, 256], [0, 80, 160, 256])
-  decreaseLookupTable = lookuptable([0, 64, 128, 256], [0, 50, 100, 256])
-  blue_channel, green_channel,red_channel = cv2.split(np_img)
-  red_channel = cv2.LUT(red_channel, decreaseLookupTable).astype(np.uint8)
-  blue_channel = cv2.LUT(blue_channel, increaseLookupTable).astype(np.uint8)
-  winter = cv2.merge((blue_channel, green_channel, red_channel))
+  winter = cv2.LUT(np_img, get_kernels()["winter_lut"])
   return winter
 
 
@@ -159,258 +237,324 @@ def apply_invert_effect(np_img):
     return inv
 
 
-def apply_all_effect(img_np, result_path, image):
-    img_file = image
-
-    #apply and save original
-    if "original" in app.config['AVAILABLE_EFFECT']:
-      save_image(img_np, os.path.join(result_path, f"original/{img_file}"))
-
-    #save light_original effect
-    if "light_original" in app.config['AVAILABLE_EFFECT']:
-      save_image(img_np, os.path.join(result_path, f"light_original/{img_file}"))
-      beauty_img = apply_beauty_filter(os.path.join(result_path, f"light_original/{img_file}"))
-      save_image(beauty_img, os.path.join(result_path, f"light_original/{img_file}"))
-    
-    #apply and save light grayscale
-    if "light_grayscale" in app.config['AVAILABLE_EFFECT']:
-      save_image(img_np, os.path.join(result_path, f"light_grayscale/{img_file}"))
-      light_grayscale_img = apply_light_grayscale_effect(os.path.join(result_path, f"original/{img_file}"))
-      save_image(light_grayscale_img, os.path.join(result_path, f"light_grayscale/{img_file}"))
-
-    #apply and save dark grayscale
-    if "dark_grayscale" in app.config['AVAILABLE_EFFECT']:
-      save_image(img_np, os.path.join(result_path, f"dark_grayscale/{img_file}"))
-      dark_grayscale_img = apply_dark_grayscale_effect(os.path.join(result_path, f"original/{img_file}"))
-      save_image(dark_grayscale_img, os.path.join(result_path, f"dark_grayscale/{img_file}"))
-
-
-
-def generate_gif(img_path, out_gif, delay=1.1):
-  img_files = os.listdir(img_path)
-  if "compiled.jpg" in img_files:
-    img_files.remove("compiled.jpg")
-  with imageio.get_writer(out_gif, format='GIF-PIL', quantizer=1, mode='I', duration=delay) as writer:
-    for filename in img_files:
-        image = imageio.imread(os.path.join(img_path, filename))
-        writer.append_data(image)
-
-
-def compile_np_image(img_path, img_list, padding=30, new_size=(560,480), mirror=True):
-  max_width = 0
-  total_height = 0
-  images = []
-
-  for img_file in img_list:
-    img_full_path = os.path.join(img_path, img_file)
-    img=load_image(img_full_path)
-    img=resize_image(img, new_size)
-    images.append(img)
-
-    image_width=img.shape[1]
-    image_height=img.shape[0]
-    if image_width > max_width:
-        max_width = image_width
-    total_height += image_height
-
-  final_image = np.zeros((total_height+(len(img_list)-1)*padding,max_width,3),dtype=np.uint8)
-  current_y = 0
-
-  for image in images:
-    height = image.shape[0]
-    width = image.shape[1]
-    final_image[current_y:height+current_y,:width,:] = image
-    current_y += height + padding
-  return final_image
+EFFECTS = {
+  "original": apply_original_effect,
+  "light_original": apply_beauty_filter,
+  "light_grayscale": apply_light_grayscale_effect,
+  "dark_grayscale": apply_dark_grayscale_effect,
+  "sepia": apply_sepia_effect,
+  "summer": apply_summer_effect,
+  "winter": apply_winter_effect,
+  "hdr": apply_hdr_effect,
+  "invert": apply_invert_effect,
+}
 
 
-def overlay_transparent(bg_img, img_to_overlay_t):
+def apply_all_effect(img_np, result_path, image, slot_size=None, faces=None):
+    img_file = image
+    results = {}
+
+    #crop and resize once, then run the effects on the slot-sized capture
+    if slot_size is not None:
+      img_np = resize_image(img_np, slot_size, faces)
+
+    #every effect starts from the decoded capture and is encoded exactly once
+    for effect in settings['AVAILABLE_EFFECT']:
+      if effect not in EFFECTS:
+        logging.warning(f"Unknown effect {effect}, skipping")
+        continue
+      with timed("effect", effect=effect):
+        results[effect] = EFFECTS[effect](img_np)
+      with timed("save_image", effect=effect):
+        save_path = os.path.join(result_path, effect, img_file)
+        save_image(results[effect], save_path, intermediate_params(save_path))
+
+    return results
+
+
+def preview_frames(images, max_size):
+  #downscale to the preview size and convert to RGB PIL images
+  frames = []
+  for np_img in images:
+    scale = min(1.0, max_size / float(max(np_img.shape[:2])))
+    if scale < 1.0:
+      np_img = cv2.resize(np_img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    if np_img.ndim == 2:
+      np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2BGR)
+    frames.append(Image.fromarray(cv2.cvtColor(np_img, cv2.COLOR_BGR2RGB)))
+  return frames
+
+
+def build_palette(frames):
+  #one palette for the whole animation, computed from every frame at once
+  mosaic = Image.new("RGB", (max(x.width for x in frames), sum(x.height for x in frames)))
+  y = 0
+  for frame in frames:
+    mosaic.paste(frame, (0, y))
+    y += frame.height
+  return mosaic.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+
+
+def generate_gif(images, out_gif, delay=1.1, max_size=720):
+  frames = preview_frames(images, max_size)
+  palette = build_palette(frames)
+  frames = [ x.quantize(palette=palette) for x in frames ]
+  frames[0].save(out_gif, format="GIF", save_all=True, append_images=frames[1:], duration=int(delay * 1000), loop=0, optimize=False)
+
+
+def generate_webp(images, out_webp, delay=1.1, max_size=720):
+  frames = preview_frames(images, max_size)
+  frames[0].save(out_webp, format="WEBP", save_all=True, append_images=frames[1:], duration=int(delay * 1000), loop=0, quality=80)
+
+
+def generate_mp4(images, out_mp4, delay=1.1, max_size=720):
+  #needs the optional imageio-ffmpeg package
+  import imageio
+  frames = preview_frames(images, max_size)
+  with imageio.get_writer(out_mp4, format="FFMPEG", fps=1.0 / delay, codec="libx264", macro_block_size=2) as writer:
+    for frame in frames:
+      #yuv420p needs even dimensions
+      writer.append_data(np.asarray(frame)[:frame.height // 2 * 2, :frame.width // 2 * 2])
+
+
+ANIMATION_WRITERS = {
+  "gif": generate_gif,
+  "webp": generate_webp,
+  "mp4": generate_mp4,
+}
+
+
+def generate_animations(images, out_prefix, delay=1.1):
+  for animation_format in settings["ANIMATION_FORMATS"]:
+    out_path = f"{out_prefix}.{animation_format}"
+    #the email worker, the results route and a concurrent generate may read out_path
+    tmp_path = temp_path(out_path)
+    try:
+      with timed(f"generate_{animation_format}"):
+        ANIMATION_WRITERS[animation_format](images, tmp_path, delay, settings["ANIMATION_MAX_SIZE"])
+        os.replace(tmp_path, out_path)
+    except Exception as e:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      #the GIF is what the UI and the email use, the other formats are best effort
+      if animation_format == "gif":
+        raise
+      logging.error(f"Cannot write {out_path}: {e}", exc_info=True)
+
+
+#decoded frame overlay with its blurred alpha mask, ready to composite
+FrameAsset = namedtuple("FrameAsset", ["overlay", "mask", "inverse_mask", "shape"])
+
+
+def prepare_overlay(img_to_overlay_t):
     b,g,r,a = cv2.split(img_to_overlay_t)
     overlay_color = cv2.merge((b,g,r))
     mask = cv2.medianBlur(a,5)
+    overlay = cv2.bitwise_and(overlay_color,overlay_color,mask = mask)
+    return FrameAsset(overlay, mask, cv2.bitwise_not(mask), img_to_overlay_t.shape)
+
+
+@lru_cache(maxsize=settings["FRAME_CACHE_SIZE"])
+def load_frame_asset(frame_path, mtime):
+  #mtime is part of the cache key so an edited frame PNG is picked up
+  return prepare_overlay(load_image(frame_path, True))
 
-    img1_bg = cv2.bitwise_and(bg_img.copy(),bg_img.copy(),mask = cv2.bitwise_not(mask))
-    img2_fg = cv2.bitwise_and(overlay_color,overlay_color,mask = mask)
-    bg_img = cv2.add(img1_bg, img2_fg)
+
+def load_frame(frame_base_dir, frame_name):
+  frame_path = os.path.join(frame_base_dir, frame_name)
+  return load_frame_asset(frame_path, os.path.getmtime(frame_path))
+
+
+def warm_frame_cache(frame_base_dir):
+  frame_names = []
+  for frame_list in ["AVAILABLE_8_FRAME", "AVAILABLE_6_FRAME", "AVAILABLE_6_FRAME_6_TAKES"]:
+    frame_names.extend(x for x in settings[frame_list] if x not in frame_names)
+
+  for frame_name in frame_names[:settings["FRAME_CACHE_SIZE"]]:
+    if os.path.exists(os.path.join(frame_base_dir, frame_name)):
+      load_frame(frame_base_dir, frame_name)
+
+
+def warm_presets():
+  for preset in [BeautyFilter, DarkenFilter, LightenFilter]:
+    preset.kernel()
+
+
+def warm_cascade():
+  if settings["FACE_AWARE_CROP"] and hasattr(cv2, "CascadeClassifier"):
+    get_cascade_classifier()
+
+
+def warm_worker(frame_base_dir):
+  #everything a first request would otherwise pay for, run once per process
+  get_kernels()
+  warm_presets()
+  warm_cascade()
+  warm_frame_cache(frame_base_dir)
+
+
+def overlay_transparent(bg_img, img_to_overlay_t):
+    frame = img_to_overlay_t
+    if not isinstance(frame, FrameAsset):
+      frame = prepare_overlay(frame)
+
+    img1_bg = cv2.bitwise_and(bg_img,bg_img,mask = frame.inverse_mask)
+    bg_img = cv2.add(img1_bg, frame.overlay)
 
     return bg_img
 
 
-def create_padding(padding_width=None, padding_height=None):
-  padding = np.zeros([padding_height,padding_width,3], dtype=np.uint8)
-  return padding
+#built-in layouts for the frame families in the config. Each column is a list of
+#capture indexes stacked top to bottom; columns are centred horizontally.
+FRAME_LAYOUTS = {
+  "AVAILABLE_6_FRAME": {
+    "slot_size": [993, 945], #(width, height)
+    "padding": 94,
+    "gutter": 188,
+    "top": 83,
+    "columns": [[0, 1, 2], [0, 1, 2]]
+  },
+  "AVAILABLE_6_FRAME_6_TAKES": {
+    "slot_size": [993, 945],
+    "padding": 94,
+    "gutter": 188,
+    "top": 83,
+    "columns": [[3, 4, 5], [0, 1, 2]]
+  },
+  "AVAILABLE_8_FRAME": {
+    "slot_size": [992, 781],
+    "padding": 22,
+    "gutter": 188,
+    "top": 71,
+    "columns": [[0, 1, 2, 3], [0, 1, 2, 3]]
+  },
+  "AVAILABLE_8_FRAME_ELLIPSE": {
+    "slot_size": [1022, 716],
+    "padding": 87,
+    "gutter": 158,
+    "top": 172,
+    "columns": [[0, 1, 2, 3], [0, 1, 2, 3]]
+  },
+}
+
+Slot = namedtuple("Slot", ["capture", "x", "y", "width", "height"])
+
+
+def column_slots(layout, frame_shape):
+  width, height = layout["slot_size"]
+  columns = layout["columns"]
+  content_width = len(columns) * width + (len(columns) - 1) * layout["gutter"]
+  left = (frame_shape[1] - content_width + 1) // 2
+
+  slots = []
+  for i, column in enumerate(columns):
+    x = left + i * (width + layout["gutter"])
+    for j, capture in enumerate(column):
+      y = layout["top"] + j * (height + layout["padding"])
+      slots.append(Slot(capture, x, y, width, height))
+  return slots
+
+
+def get_frame_layout(frame_base_dir, frame_name):
+  #a JSON sidecar next to the frame wins, then FRAME_LAYOUTS in the config, then the frame family
+  sidecar_path = os.path.join(frame_base_dir, os.path.splitext(frame_name)[0] + ".json")
+  if os.path.exists(sidecar_path):
+    with open(sidecar_path) as f:
+      return json.load(f)
+
+  if frame_name in settings["FRAME_LAYOUTS"]:
+    return settings["FRAME_LAYOUTS"][frame_name]
+
+  if frame_name in settings["AVAILABLE_8_FRAME_ELLIPSE"] and frame_name in settings["AVAILABLE_8_FRAME"]:
+    return FRAME_LAYOUTS["AVAILABLE_8_FRAME_ELLIPSE"]
+  for family in ["AVAILABLE_6_FRAME", "AVAILABLE_6_FRAME_6_TAKES", "AVAILABLE_8_FRAME"]:
+    if frame_name in settings[family]:
+      return FRAME_LAYOUTS[family]
+
+  raise ValueError(f"No layout defined for {frame_name}")
+
+
+def get_frame_slots(layout, frame_shape):
+  #explicit slots: [{"capture": 0, "x": 95, "y": 83, "width": 993, "height": 945}, ...]
+  if "slots" in layout:
+    return [ Slot(x["capture"], x["x"], x["y"], x["width"], x["height"]) for x in layout["slots"] ]
+  return column_slots(layout, frame_shape)
+
+
+def get_slot_size(frame_base_dir, frame_name):
+  #the single (width, height) every capture is shown at, None if the layout mixes sizes
+  layout = get_frame_layout(frame_base_dir, frame_name)
+  if "slots" in layout:
+    sizes = set((x["width"], x["height"]) for x in layout["slots"])
+  else:
+    sizes = set([tuple(layout["slot_size"])])
+  return sizes.pop() if len(sizes) == 1 else None
+
 
+def list_captures(img_path):
+  #everything in an effect directory except the compiled and print outputs is a capture
+  return sorted(x for x in os.listdir(img_path) if not x.startswith(("compiled.", "print.", ".")))
 
-def compile_frame(frame_id, src_img_path, frame_base_dir):
+
+def load_captures(img_path):
+  return [ load_image(os.path.join(img_path, x)) for x in list_captures(img_path) ]
+
+
+def compose_slots(images, slots, frame_shape, faces=None):
+  #the canvas is allocated once and every capture is written straight into its slot
+  canvas = np.zeros((frame_shape[0], frame_shape[1], 3), dtype=np.uint8)
+  resized = {}
+  for slot in slots:
+    #a session with fewer captures than the layout has slots leaves the rest empty
+    if slot.capture >= len(images):
+      continue
+    key = (slot.capture, slot.width, slot.height)
+    if key not in resized:
+      capture_faces = faces[slot.capture] if faces and slot.capture < len(faces) else None
+      resized[key] = resize_image(images[slot.capture], (slot.width, slot.height), capture_faces)
+    canvas[slot.y:slot.y + slot.height, slot.x:slot.x + slot.width] = resized[key]
+  return canvas
+
+
+def compile_frame(frame_id, src_img_path, frame_base_dir, images=None, faces=None):
   frame_name = f"frame-{frame_id}.png"
-  frame_img = load_image(os.path.join(frame_base_dir, frame_name), True)
-  img_list = os.listdir(src_img_path)  
-
-  if frame_name in app.config['AVAILABLE_6_FRAME']:
-    compiled_image = compile_np_image(
-      src_img_path,
-      img_list,
-      padding=94,
-      new_size=(993,945) #(width, height)
-    )
-    center_padding = create_padding(
-      padding_width=188,
-      padding_height=compiled_image.shape[0]
-    )
-    
-    compiled_image = cv2.hconcat([compiled_image, center_padding, compiled_image])
-
-    height_diff = frame_img.shape[0] - compiled_image.shape[0]
-    top_padding = create_padding(
-      padding_width=compiled_image.shape[1],
-      padding_height=83
-    )
-    bottom_padding = create_padding(
-      padding_width=compiled_image.shape[1],
-      padding_height= height_diff - top_padding.shape[0]
-    )
-
-    compiled_image = cv2.vconcat([top_padding, compiled_image, bottom_padding])
-    
-    width_diff = frame_img.shape[1] - compiled_image.shape[1]
-    right_padding = create_padding(
-      padding_width=width_diff//2,
-      padding_height=compiled_image.shape[0]
-    )
-    left_padding = create_padding(
-      padding_width=(width_diff//2)+1,
-      padding_height= compiled_image.shape[0]
-    )
-
-    compiled_image = cv2.hconcat([left_padding, compiled_image, right_padding])
-    final_image = overlay_transparent(compiled_image, frame_img)
+  frame_img = load_frame(frame_base_dir, frame_name)
+  slots = get_frame_slots(get_frame_layout(frame_base_dir, frame_name), frame_img.shape)
 
-    return final_image
-  elif frame_name in app.config['AVAILABLE_6_FRAME_6_TAKES']:
-    compiled_col_1 = compile_np_image(
-      src_img_path,
-      img_list[3:],
-      padding=94,
-      new_size=(993,945) #(width, height)
-    )
-    compiled_col_2 = compile_np_image(
-      src_img_path,
-      img_list[:3],
-      padding=94,
-      new_size=(993,945) #(width, height)
-    )
-    center_padding = create_padding(
-      padding_width=188,
-      padding_height=compiled_col_2.shape[0]
-    )
-    
-    compiled_image = cv2.hconcat([compiled_col_1, center_padding, compiled_col_2])
-
-    height_diff = frame_img.shape[0] - compiled_image.shape[0]
-    top_padding = create_padding(
-      padding_width=compiled_image.shape[1],
-      padding_height=83
-    )
-    bottom_padding = create_padding(
-      padding_width=compiled_image.shape[1],
-      padding_height= height_diff - top_padding.shape[0]
-    )
-
-    compiled_image = cv2.vconcat([top_padding, compiled_image, bottom_padding])
-    
-    width_diff = frame_img.shape[1] - compiled_image.shape[1]
-    right_padding = create_padding(
-      padding_width=width_diff//2,
-      padding_height=compiled_image.shape[0]
-    )
-    left_padding = create_padding(
-      padding_width=(width_diff//2)+1,
-      padding_height= compiled_image.shape[0]
-    )
-
-    compiled_image = cv2.hconcat([left_padding, compiled_image, right_padding])
-    final_image = overlay_transparent(compiled_image, frame_img)
+  if images is None:
+    images = load_captures(src_img_path)
 
-    return final_image
-    
-  elif frame_name in app.config['AVAILABLE_8_FRAME'] and frame_name not in app.config['AVAILABLE_8_FRAME_ELLIPSE']:
-    compiled_image_col = compile_np_image(
-      src_img_path,
-      img_list,
-      padding=22,
-      new_size=(992,781)
-    )
-    center_padding = create_padding(
-      padding_width=188,
-      padding_height=compiled_image_col.shape[0]
-    )
-
-    compiled_image = cv2.hconcat([compiled_image_col, center_padding, compiled_image_col])
-    
-    height_diff = frame_img.shape[0] - compiled_image.shape[0]
-    top_padding = create_padding(
-      padding_width=compiled_image.shape[1],
-      padding_height=71
-    )
-    bottom_padding = create_padding(
-      padding_width=compiled_image.shape[1],
-      padding_height= height_diff - top_padding.shape[0]
-    )
-
-    compiled_image = cv2.vconcat([top_padding, compiled_image, bottom_padding])
-
-    width_diff = frame_img.shape[1] - compiled_image.shape[1]
-    right_padding = create_padding(
-      padding_width=width_diff//2,
-      padding_height=compiled_image.shape[0]
-    )
-    left_padding = create_padding(
-      padding_width=(width_diff//2)+1,
-      padding_height= compiled_image.shape[0]
-    )
-
-    compiled_image = cv2.hconcat([left_padding, compiled_image, right_padding])
+  with timed("compile"):
+    compiled_image = compose_slots(images, slots, frame_img.shape, faces)
+  with timed("overlay_transparent"):
     final_image = overlay_transparent(compiled_image, frame_img)
+  return final_image
+
+
+@lru_cache(maxsize=1)
+def srgb_profile():
+  return ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+
+
+def fit_print_size(np_img, print_size):
+  #turn the image to the paper orientation and fit it, centred, on a page of exactly print_size
+  width, height = print_size
+  if (np_img.shape[1] > np_img.shape[0]) != (width > height):
+    np_img = cv2.rotate(np_img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+  scale = min(width / float(np_img.shape[1]), height / float(np_img.shape[0]))
+  size = (min(width, round(np_img.shape[1] * scale)), min(height, round(np_img.shape[0] * scale)))
+  interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LANCZOS4
+  np_img = cv2.resize(np_img, size, interpolation=interpolation)
+
+  page = np.full((height, width, 3), 255, dtype=np.uint8)
+  left = (width - size[0]) // 2
+  top = (height - size[1]) // 2
+  page[top:top + size[1], left:left + size[0]] = np_img
+  return page
 
-    return final_image
-
-  elif frame_name in app.config['AVAILABLE_8_FRAME'] and frame_name in app.config['AVAILABLE_8_FRAME_ELLIPSE']:
-    compiled_image_col = compile_np_image(
-      src_img_path,
-      img_list,
-      padding=87,
-      new_size=(1022,716)
-    )
-    center_padding = create_padding(
-      padding_width=158,
-      padding_height=compiled_image_col.shape[0]
-    )
-
-    compiled_image = cv2.hconcat([compiled_image_col, center_padding, compiled_image_col])
-    
-    height_diff = frame_img.shape[0] - compiled_image.shape[0]
-    top_padding = create_padding(
-      padding_width=compiled_image.shape[1],
-      padding_height=172
-    )
-    bottom_padding = create_padding(
-      padding_width=compiled_image.shape[1],
-      padding_height= height_diff - top_padding.shape[0]
-    )
-
-    compiled_image = cv2.vconcat([top_padding, compiled_image, bottom_padding])
-
-    width_diff = frame_img.shape[1] - compiled_image.shape[1]
-    right_padding = create_padding(
-      padding_width=width_diff//2,
-      padding_height=compiled_image.shape[0]
-    )
-    left_padding = create_padding(
-      padding_width=(width_diff//2)+1,
-      padding_height= compiled_image.shape[0]
-    )
-
-    compiled_image = cv2.hconcat([left_padding, compiled_image, right_padding])
-    final_image = overlay_transparent(compiled_image, frame_img)
 
-    return final_image
\ No newline at end of file
+def save_print_image(np_img, save_path):
+  #tagged as sRGB so the printer driver colour-manages it instead of guessing
+  img = Image.fromarray(cv2.cvtColor(np_img, cv2.COLOR_BGR2RGB))
+  img.save(save_path, format="JPEG", quality=95, subsampling=0, icc_profile=srgb_profile())
@@ -0,0 +1,101 @@
+import os
+import time
+import logging
+import threading
+from config import app
+from pipeline import prepare_in_background
+from storage import source_dir
+
+
+class IngestTracker:
+    #a session is opened once the frame is known, from then on every capture that
+    #lands in IMG_SRC_BASE_DIR/<tx_id> is rendered while the guest keeps shooting
+    def __init__(self, poll_interval, session_ttl):
+        self.poll_interval = poll_interval
+        self.session_ttl = session_ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def start(self):
+        #without the watcher only uploads through the API are ingested
+        if not app.config["INGEST_WATCH"]:
+            return
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self.run_worker, name="ingest-watcher", daemon=True)
+            self.worker.start()
+
+    def open_session(self, tx_id, frame_id):
+        self.start()
+        with self.lock:
+            session = self.sessions.setdefault(tx_id, {"seen": None, "ingested": None})
+            changed = session.get("frame_id") != frame_id
+            session["frame_id"] = frame_id
+            session["updated_at"] = time.time()
+            if changed:
+                #a new frame may mean a new slot size, everything is ingested again
+                session["ingested"] = None
+        return changed
+
+    def frame_for(self, tx_id):
+        with self.lock:
+            session = self.sessions.get(tx_id)
+            return session["frame_id"] if session else None
+
+    def ingest(self, tx_id):
+        #uploads don't wait for the next poll
+        frame_id = self.frame_for(tx_id)
+        if frame_id is None:
+            return False
+        snapshot = self.snapshot(tx_id)
+        if not snapshot:
+            return False
+        with self.lock:
+            self.sessions[tx_id]["updated_at"] = time.time()
+            self.sessions[tx_id]["ingested"] = snapshot
+        prepare_in_background(tx_id, frame_id)
+        return True
+
+    def snapshot(self, tx_id):
+        source_path = source_dir(tx_id)
+        if not os.path.isdir(source_path):
+            return {}
+        snapshot = {}
+        for img_file in os.listdir(source_path):
+            if img_file.startswith("."):
+                continue
+            stat = os.stat(os.path.join(source_path, img_file))
+            snapshot[img_file] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self):
+        now = time.time()
+        with self.lock:
+            for tx_id in [ x for x, session in self.sessions.items() if now - session["updated_at"] > self.session_ttl ]:
+                del self.sessions[tx_id]
+            sessions = list(self.sessions.items())
+
+        for tx_id, session in sessions:
+            snapshot = self.snapshot(tx_id)
+            #camera software may still be writing, a directory is only ingested once
+            #it looks the same on two polls in a row
+            if snapshot != session["seen"]:
+                session["seen"] = snapshot
+                continue
+            if snapshot and snapshot != session["ingested"]:
+                session["ingested"] = snapshot
+                session["updated_at"] = now
+                prepare_in_background(tx_id, session["frame_id"])
+
+    def run_worker(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error(f"Ingest poll failed: {e}", exc_info=True)
+
+
+ingest_tracker = IngestTracker(app.config["INGEST_POLL_INTERVAL"], app.config["INGEST_SESSION_TTL"])
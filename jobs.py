@@ -0,0 +1,99 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+from config import app
+
+
+class Job:
+    def __init__(self, target, args, progress):
+        self.job_id = uuid.uuid4().hex
+        self.target = target
+        self.args = args
+        self.status = "queued"
+        self.progress = progress
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def update(self, key, value):
+        self.progress[key] = value
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+
+class JobQueue:
+    def __init__(self, worker_count, history_size=500):
+        self.worker_count = worker_count
+        self.history_size = history_size
+        self.pending = queue.Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for i in range(self.worker_count):
+                worker = threading.Thread(target=self.run_worker, name=f"job-worker-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, target, args, progress=None):
+        #target is called as target(*args, job) so it can report progress
+        self.start()
+        job = Job(target, args, progress or {})
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self.prune()
+        self.pending.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def prune(self):
+        finished = [job for job in self.jobs.values() if job.finished_at is not None]
+        for job in sorted(finished, key=lambda job: job.finished_at)[:len(self.jobs) - self.history_size]:
+            del self.jobs[job.job_id]
+
+    def drain(self, timeout):
+        #wait for queued and running jobs, false if they did not finish in time
+        deadline = time.time() + timeout
+        with self.pending.all_tasks_done:
+            while self.pending.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.pending.all_tasks_done.wait(remaining)
+        return True
+
+    def run_worker(self):
+        while True:
+            job = self.pending.get()
+            job.status = "running"
+            try:
+                job.result = job.target(*job.args, job)
+                job.status = "done"
+            except Exception as e:
+                logging.error(f"Job {job.job_id} failed: {e}", exc_info=True)
+                job.error = f"{e}"
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                self.pending.task_done()
+
+
+job_queue = JobQueue(app.config["JOB_WORKERS"])
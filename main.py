@@ -1,89 +1,200 @@
 import json
 import os
 import logging
-from flask import jsonify, request, url_for
+from flask import Response, jsonify, request, stream_with_context
+from markupsafe import escape
+from werkzeug.utils import secure_filename
 from config import app
-from image_processing import *
-from send_email import *
-from printer_utils import *
-from threading import Thread
+from send_email import attachment_paths
+from pipeline import generate_session, iter_session, order_effects, available_effects
+from uploads import save_upload
+from ingest import ingest_tracker
+from jobs import job_queue
+from email_queue import email_outbox
+from print_spooler import print_spooler
+from metrics import registry, summarize
+from startup import warmup, start_services
+from results import result_path, result_url, send_result
+from storage import storage, result_dir, source_dir
+from image_processing import list_captures
+from concurrency import limiter
+
+limiter.init_app(app)
+
+def public_base_url():
+    #behind a reverse proxy or on the booth LAN the Host header is not what the
+    #tablets and the printer can reach, PUBLIC_BASE_URL overrides it
+    return (app.config["PUBLIC_BASE_URL"] or request.host_url).rstrip("/")
+
+
+def effect_urls(base_url, tx_id, effect):
+    #the first capture, its name depends on the source and INTERMEDIATE_FORMAT
+    effect_path = os.path.join(result_dir(tx_id), effect)
+    captures = list_captures(effect_path) if os.path.isdir(effect_path) else []
+    return {
+        "img_url": result_url(base_url, tx_id, effect, captures[0]) if captures else None,
+        "gif_url": result_url(base_url, tx_id, effect, "compiled.gif"),
+        "compiled_url": result_url(base_url, tx_id, effect, "compiled.jpg")
+    }
+
+
+def generate_result(base_url, tx_id, effects):
+    urls = [ effect_urls(base_url, tx_id, effect) for effect in order_effects(effects) ]
+    return {
+        "img_url": [ x["img_url"] for x in urls ],
+        "gif_url": [ x["gif_url"] for x in urls ],
+        "compiled_url": [ x["compiled_url"] for x in urls ]
+    }
+
+
+def run_generate_job(base_url, tx_id, frame_id, with_timings, job):
+    #runs outside the request, the base URL is resolved when the job is submitted
+    def on_effect_done(effect):
+        job.update(effect, {"status": "done", **effect_urls(base_url, tx_id, effect)})
+
+    timings = [] if with_timings else None
+    effects = generate_session(tx_id, frame_id, on_effect_done=on_effect_done, timings=timings)
+    result = generate_result(base_url, tx_id, effects)
+    if with_timings:
+        result["timings"] = summarize(timings)
+    return result
+
 
 @app.route("/api/generate-image", methods=["POST"])
 def generate_image_api():
     content = request.json
     tx_id = content["tx_id"]
     frame_id = content["frame_id"]
-    source_path = os.path.join(app.config["IMG_SRC_BASE_DIR"], tx_id)
-    result_path = os.path.join(app.config["IMG_RESULT_BASE_DIR"], tx_id)
+    with_timings = content.get("timings", False)
     
     try:
-
-        for effect in app.config["AVAILABLE_EFFECT"]:
-            os.makedirs(f"{result_path}/{effect}", exist_ok=True)
-        
-        img_list = os.listdir(source_path)
-        logging.info(f"Applying filter for {tx_id} images")
-        for img_file in img_list:
-            img_file_path = os.path.join(source_path, img_file)
-
-            img_np = load_image(img_file_path)
-            apply_all_effect(img_np, result_path, img_file)
-        
-        available_filter_result = os.listdir(result_path)
-        logging.info(f"Compiling images for {tx_id}")
-        for effect_dir in available_filter_result:
-            compiled_np = compile_frame(
-                frame_id=frame_id,
-                src_img_path=os.path.join(result_path,effect_dir),
-                frame_base_dir=app.config['IMG_FRAME_BASE_DIR']
-            )
-            save_image(compiled_np, os.path.join(result_path, f"{effect_dir}/compiled.jpg"))
-
-            generate_gif(
-                os.path.join(result_path,effect_dir),
-                os.path.join(result_path, f"{effect_dir}/compiled.gif"),
-                delay=0.7
+        if content.get("async", False):
+            job = job_queue.submit(
+                run_generate_job,
+                [public_base_url(), tx_id, frame_id, with_timings],
+                progress={ x: {"status": "pending"} for x in order_effects(available_effects()) }
             )
+            data = {
+                "status_code": 202,
+                "message": "Accepted",
+                "job_id": job.job_id,
+                "status_url": f"{public_base_url()}/api/jobs/{job.job_id}",
+                "result_url": f"{public_base_url()}/api/jobs/{job.job_id}/result",
+                "error": "null"
+            }
+            return jsonify(data), 202
 
-        img_url = [ f"http://localhost:8080/static/res_image/{tx_id}/{x}/1.png" for x in os.listdir(result_path) ]
-        img_url.insert(0, img_url.pop(img_url.index(
-                f"http://localhost:8080/static/res_image/{tx_id}/light_original/1.png"
-            )))
-
-        gif_url = [ f"http://localhost:8080/static/res_image/{tx_id}/{x}/compiled.gif" for x in os.listdir(result_path) ]
-        gif_url.insert(0, gif_url.pop(gif_url.index(
-            f"http://localhost:8080/static/res_image/{tx_id}/light_original/compiled.gif"
-        )))
-
-        compiled_url = [ f"http://localhost:8080/static/res_image/{tx_id}/{x}/compiled.jpg" for x in os.listdir(result_path) ]
-        compiled_url.insert(0, compiled_url.pop(compiled_url.index(
-            f"http://localhost:8080/static/res_image/{tx_id}/light_original/compiled.jpg"
-        )))
-        
+        timings = [] if with_timings else None
+        effects = generate_session(tx_id, frame_id, timings=timings)
         data = {
             "status_code": 200,
             "message": "Success",
-            "img_url": img_url,
-            "gif_url": gif_url,
-            "compiled_url": compiled_url,
+            **generate_result(public_base_url(), tx_id, effects),
             "error": "null"
         }
+        if with_timings:
+            data["timings"] = summarize(timings)
         return jsonify(data), 200
     except Exception as e:
         logging.error(f"Error: {e}", exc_info=True)        
         data = {
             "status_code": 503,
             "message": "Cannot process the image",
-            "error": e
+            "error": f"{e}"
         }
         return jsonify(data), 503
 
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/api/generate-image/stream", methods=["GET", "POST"])
+def generate_image_stream_api():
+    #GET takes query parameters so the front-end can use EventSource directly
+    content = request.json if request.is_json else request.args
+    tx_id = content["tx_id"]
+    frame_id = content["frame_id"]
+    base_url = public_base_url()
+
+    def events():
+        try:
+            for effect in iter_session(tx_id, frame_id):
+                yield sse_event("effect", {"effect": effect, **effect_urls(base_url, tx_id, effect)})
+            yield sse_event("done", {"status_code": 200, "message": "Success", "error": "null"})
+        except Exception as e:
+            logging.error(f"Error: {e}", exc_info=True)
+            yield sse_event("error", {"status_code": 503, "message": "Cannot process the image", "error": f"{e}"})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_status_api(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        data = {
+            "status_code": 404,
+            "message": "Job not found",
+            "error": "null"
+        }
+        return jsonify(data), 404
+
+    data = {
+        "status_code": 200,
+        "message": "Success",
+        "job": job.to_dict(),
+        "error": "null"
+    }
+    return jsonify(data), 200
+
+
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def job_result_api(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        data = {
+            "status_code": 404,
+            "message": "Job not found",
+            "error": "null"
+        }
+        return jsonify(data), 404
+
+    if job.status == "failed":
+        data = {
+            "status_code": 503,
+            "message": "Cannot process the image",
+            "error": job.error
+        }
+        return jsonify(data), 503
+
+    if job.status != "done":
+        data = {
+            "status_code": 202,
+            "message": "Job is still running",
+            "job": job.to_dict(),
+            "error": "null"
+        }
+        return jsonify(data), 202
+
+    data = {
+        "status_code": 200,
+        "message": "Success",
+        **job.result,
+        "error": "null"
+    }
+    return jsonify(data), 200
+
+
 @app.route("/api/get-frame", methods=["GET"])
 def get_frame_api():
-    eight_frame_list = [ f"http://localhost:8080/static/frame_assets/{x}" for x in app.config['AVAILABLE_8_FRAME'] ]
-    six_frame_list = [ f"http://localhost:8080/static/frame_assets/{x}" for x in app.config['AVAILABLE_6_FRAME'] ]
-    six_frame_six_takes_list = [ f"http://localhost:8080/static/frame_assets/{x}" for x in app.config['AVAILABLE_6_FRAME_6_TAKES'] ]
+    eight_frame_list = [ f"{public_base_url()}/static/frame_assets/{x}" for x in app.config['AVAILABLE_8_FRAME'] ]
+    six_frame_list = [ f"{public_base_url()}/static/frame_assets/{x}" for x in app.config['AVAILABLE_6_FRAME'] ]
+    six_frame_six_takes_list = [ f"{public_base_url()}/static/frame_assets/{x}" for x in app.config['AVAILABLE_6_FRAME_6_TAKES'] ]
     data = {
         "status_code": 200,
         "message": "Success",
@@ -104,17 +215,19 @@ def send_email_api():
     email = content['email']
     recipient_name = content['recipient_name']
 
-    composed_email = compose_email(recipient_name, [email], tx_id, effect)
-
     try:
-        thr = Thread(
-            target=send_email,
-            args=[app,composed_email,email,app.config['SMTP_SERVERNAME'],app.config['SMTP_SERVERPORT']]
+        #only check the attachments exist, composing and encoding happen in the outbox worker
+        for path in attachment_paths(tx_id, effect):
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"{path} does not exist")
+        email_id = email_outbox.enqueue(
+            [email],
+            {"recipient_name": recipient_name, "tx_id": tx_id, "effect": effect}
         )
-        thr.start()
         data = {
             "status_code": 200,
             "message": "Success",
+            "email_id": email_id,
             "error": "null"
         }
         return jsonify(data), 200
@@ -128,21 +241,49 @@ def send_email_api():
         return jsonify(data), 503
 
 
+@app.route("/api/emails/<email_id>", methods=['GET'])
+def email_status_api(email_id):
+    email_status = email_outbox.get(email_id)
+    if email_status is None:
+        data = {
+            "status_code": 404,
+            "message": "Email not found",
+            "error": "null"
+        }
+        return jsonify(data), 404
+
+    data = {
+        "status_code": 200,
+        "message": "Success",
+        "email": email_status,
+        "error": "null"
+    }
+    return jsonify(data), 200
+
+
 @app.route("/api/print-image", methods=['POST'])
 def print_image_api():
     content = request.json
     tx_id = content['tx_id']
     effect = content['effect']
+    printer = content.get('printer')
 
-    result_path = os.path.join(app.config["IMG_RESULT_BASE_DIR"], tx_id)
+    result_path = result_dir(tx_id)
+    storage.touch(tx_id)
 
     try:
-        img_file = os.path.join(result_path, f"{effect}/compiled.jpg")
-        print_image_hotfolder(img_file)
+        #the pre-rendered print image is handed off as is, compiled.jpg is the fallback
+        img_file = os.path.join(result_path, f"{effect}/print.jpg")
+        if not os.path.isfile(img_file):
+            img_file = os.path.join(result_path, f"{effect}/compiled.jpg")
+        #a second tap on the same tx_id and effect returns the job already queued
+        job, duplicate = print_spooler.submit(printer, tx_id, effect, img_file)
 
         data = {
             "status_code": 200,
             "message": "Success",
+            "job_id": job.job_id,
+            "duplicate": duplicate,
             "error": "null"
         }
         return jsonify(data), 200
@@ -155,25 +296,109 @@ def print_image_api():
         }
         return jsonify(data), 503
 
+
+@app.route("/api/print-jobs", methods=['GET'])
+def print_jobs_api():
+    data = {
+        "status_code": 200,
+        "message": "Success",
+        "jobs": [job.to_dict() for job in print_spooler.list()],
+        "error": "null"
+    }
+    return jsonify(data), 200
+
+
+@app.route("/api/print-jobs/<job_id>", methods=['GET'])
+def print_job_status_api(job_id):
+    job = print_spooler.get(job_id)
+    if job is None:
+        data = {
+            "status_code": 404,
+            "message": "Print job not found",
+            "error": "null"
+        }
+        return jsonify(data), 404
+
+    data = {
+        "status_code": 200,
+        "message": "Success",
+        "job": job.to_dict(),
+        "error": "null"
+    }
+    return jsonify(data), 200
+
+@app.route("/api/sessions", methods=["POST"])
+def open_session_api():
+    content = request.json
+    tx_id = content["tx_id"]
+    frame_id = content["frame_id"]
+
+    try:
+        if not tx_id or secure_filename(tx_id) != tx_id:
+            raise ValueError(f"Invalid tx_id {tx_id}")
+        #captures that are already there are ingested right away, later ones as they arrive
+        ingest_tracker.open_session(tx_id, frame_id)
+        ingest_tracker.ingest(tx_id)
+        data = {
+            "status_code": 200,
+            "message": "Success",
+            "tx_id": tx_id,
+            "frame_id": frame_id,
+            "error": "null"
+        }
+        return jsonify(data), 200
+    except Exception as e:
+        logging.error(f"Error: {e}", exc_info=True)
+        data = {
+            "status_code": 503,
+            "message": "Cannot open the session",
+            "error": f"{e}"
+        }
+        return jsonify(data), 503
+
+
 @app.route("/api/upload-image", methods=["POST"])
 def upload_image_api():
     tx_id = str(request.form['tx_id'])
+    frame_id = request.form.get('frame_id')
     img_files = request.files.getlist("img_file")
-    src_img_base_dir = app.config["IMG_SRC_BASE_DIR"]
+
+    if not tx_id or secure_filename(tx_id) != tx_id:
+        logging.warning(f"Rejected upload for {tx_id}: invalid tx_id")
+        data = {
+            "status_code": 400,
+            "message": "Invalid tx_id",
+            "error": f"Invalid tx_id {tx_id}"
+        }
+        return jsonify(data), 400
 
     try:
-        img_dir = f"{src_img_base_dir}/{tx_id}"
+        img_dir = source_dir(tx_id)
         os.makedirs(img_dir, exist_ok=True)
-        for img in img_files:
-            img.save(os.path.join(img_dir, img.filename))
+        saved_files = [ save_upload(img, img_dir) for img in img_files ]
+
+        #with the frame known the effects can start now, generate picks up the results
+        if frame_id is not None:
+            ingest_tracker.open_session(tx_id, frame_id)
+        processing = len(saved_files) > 0 and ingest_tracker.ingest(tx_id)
         
         data = {
             "status_code": 200,
             "message": "Success",
+            "files": saved_files,
+            "processing": processing,
             "error": "null"
         }
         
         return jsonify(data), 200
+    except ValueError as e:
+        logging.warning(f"Rejected upload for {tx_id}: {e}")
+        data = {
+            "status_code": 400,
+            "message": "Invalid image",
+            "error": f"{e}"
+        }
+        return jsonify(data), 400
     except Exception as e:
         logging.error(f"Error: {e}", exc_info=True)
         data = {
@@ -184,10 +409,74 @@ def upload_image_api():
         return jsonify(data), 503
 
 
-@app.route("/static/res_image/<tx_id>/effect", methods=["GET"])
+@app.route("/metrics", methods=["GET"])
+def metrics_api():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/storage", methods=["GET"])
+def storage_api():
+    try:
+        data = {
+            "status_code": 200,
+            "message": "Success",
+            **storage.usage(),
+            "error": "null"
+        }
+        return jsonify(data), 200
+    except Exception as e:
+        logging.error(f"Error: {e}", exc_info=True)
+        data = {
+            "status_code": 503,
+            "message": "Cannot read storage usage",
+            "error": f"{e}"
+        }
+        return jsonify(data), 503
+
+
+@app.route("/api/health", methods=["GET"])
+def health_api():
+    #503 until the warm-up has finished, so a load balancer only routes to a warm server
+    ready = warmup.ready() and not limiter.draining
+    if limiter.draining:
+        message = "Draining"
+    elif ready:
+        message = "Ready"
+    elif warmup.state in ["idle", "starting"]:
+        message = "Starting"
+    else:
+        message = "Unhealthy"
+    data = {
+        "status_code": 200 if ready else 503,
+        "message": message,
+        **warmup.to_dict(),
+        "error": "null"
+    }
+    return jsonify(data), data["status_code"]
+
+
+@app.route("/static/res_image/<tx_id>/<effect>/<filename>", methods=["GET"])
+def result_file_api(tx_id, effect, filename):
+    path = result_path(tx_id, effect, filename)
+    if path is None or not os.path.isfile(path):
+        data = {
+            "status_code": 404,
+            "message": "Not found",
+            "error": f"{tx_id}/{effect}/{filename} does not exist"
+        }
+        return jsonify(data), 404
+    return send_result(path, request.args.get("v"), request.args.get("w", type=int))
+
+
+@app.route("/static/res_image/<tx_id>/<effect>", methods=["GET"])
 def image_url(tx_id, effect):
-    return "<img src=" + url_for('static', filename=f'{tx_id}/{effect}/compiled.jpg') + ">"
+    return f'<img src="{escape(result_url(public_base_url(), tx_id, effect, "compiled.jpg"))}">'
 
 
 if __name__ == "__main__":
-    app.run(host='localhost', port='8080', debug=True)
\ No newline at end of file
+    #development server, production runs through serve.py
+    debug = True
+    #with the reloader on, only the serving child process runs the background workers
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_services()
+    app.run(host=app.config["SERVER_HOST"], port=app.config["SERVER_PORT"], debug=debug, threaded=True)
@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def digest(value):
+    #stable hash of any JSON-serializable value
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def file_digest(*paths):
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def source_hashes(source_path, known):
+    #a capture is only hashed again when its size or mtime changed since the last run
+    sources = {}
+    #dot files are uploads still being written
+    for img_file in sorted(x for x in os.listdir(source_path) if not x.startswith(".")):
+        stat = file_stat(os.path.join(source_path, img_file))
+        entry = known.get(img_file, {})
+        if entry.get("size") == stat["size"] and entry.get("mtime_ns") == stat["mtime_ns"]:
+            sources[img_file] = entry
+        else:
+            sources[img_file] = {**stat, "sha1": file_digest(os.path.join(source_path, img_file))}
+    return sources
+
+
+def empty_manifest():
+    return {"version": MANIFEST_VERSION, "sources": {}, "captures": {}, "effects": {}}
+
+
+def load_manifest(result_path):
+    try:
+        with open(os.path.join(result_path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return empty_manifest()
+    except ValueError:
+        logging.warning(f"Ignoring unreadable manifest in {result_path}")
+        return empty_manifest()
+    if manifest.get("version") != MANIFEST_VERSION:
+        return empty_manifest()
+    return manifest
+
+
+def save_manifest(result_path, manifest):
+    #a crash mid-write must leave the previous manifest, not a truncated one
+    tmp_path = os.path.join(result_path, f".{MANIFEST_NAME}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, os.path.join(result_path, MANIFEST_NAME))
+
+
+def manifest_lock(result_path):
+    with _locks_lock:
+        return _locks.setdefault(result_path, threading.Lock())
+
+
+@contextmanager
+def locked_manifest(result_path):
+    #read-modify-write of a tx_id manifest, generate and background ingest share it
+    with manifest_lock(result_path):
+        manifest = load_manifest(result_path)
+        yield manifest
+        save_manifest(result_path, manifest)
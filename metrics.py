@@ -0,0 +1,107 @@
+import time
+import threading
+from contextlib import contextmanager
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf")]
+
+_local = threading.local()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class MetricsRegistry:
+    #one histogram per stage and label set, labels are usually effect and frame_id
+    def __init__(self, name):
+        self.name = name
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, **labels):
+        key = (stage, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None)))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def render(self):
+        #Prometheus text exposition format, the buckets are cumulative
+        lines = [
+            f"# HELP {self.name} Time spent in each pipeline stage in seconds",
+            f"# TYPE {self.name} histogram"
+        ]
+        with self.lock:
+            for (stage, labels), histogram in sorted(self.histograms.items()):
+                label_str = ",".join(f'{k}="{escape_label(v)}"' for k, v in (("stage", stage),) + labels)
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{self.name}_bucket{{{label_str},le="{le}"}} {count}')
+                lines.append(f"{self.name}_sum{{{label_str}}} {histogram.sum}")
+                lines.append(f"{self.name}_count{{{label_str}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+registry = MetricsRegistry("photobooth_stage_seconds")
+
+
+def record(stage, seconds, **labels):
+    #inside collect_timings the record is kept for the caller, e.g. to send it back
+    #from a pool worker; otherwise it goes straight into this process's registry
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        registry.observe(stage, seconds, **labels)
+    else:
+        timings.append({"stage": stage, "seconds": seconds, **_local.labels, **labels})
+
+
+@contextmanager
+def timed(stage, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def collect_timings(**labels):
+    #labels given here are added to every record collected inside the block
+    _local.timings, _local.labels = [], labels
+    try:
+        yield _local.timings
+    finally:
+        _local.timings, _local.labels = None, {}
+
+
+def observe_all(records, **labels):
+    for x in records:
+        x = {**x, **labels}
+        registry.observe(x.pop("stage"), x.pop("seconds"), **x)
+
+
+def summarize(records):
+    #total seconds per stage and effect, summed over every capture and worker
+    rows = {}
+    for x in records:
+        key = (x["stage"], x.get("effect"))
+        row = rows.setdefault(key, {"stage": x["stage"], "effect": x.get("effect"), "count": 0, "seconds": 0.0})
+        row["count"] += 1
+        row["seconds"] += x["seconds"]
+    for row in rows.values():
+        row["seconds"] = round(row["seconds"], 4)
+    return sorted(rows.values(), key=lambda row: (row["stage"], row["effect"] or ""))
@@ -0,0 +1,390 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from settings import settings, config_errors
+from metrics import timed, collect_timings, observe_all
+from manifest import digest, file_digest, file_stat, source_hashes, locked_manifest
+from storage import storage, result_dir, source_dir
+from image_processing import load_image, load_captures, save_image, apply_all_effect, compile_frame, generate_animations, get_slot_size, warm_worker, find_faces, list_captures, fit_print_size, save_print_image, get_frame_layout, capture_name, EFFECTS
+import image_processing
+import presets
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+#workers are spawned, not forked: by the time the pool starts the server already runs
+#the outbox, spooler and ingest threads, and a fork could copy one of their locks held
+_mp_context = multiprocessing.get_context("spawn")
+
+#set in each worker by init_worker, start_worker_pool meets every worker at it
+_worker_ready = None
+WORKER_READY_TIMEOUT = 300
+
+#stage-1 tasks by (result_path, img_file, capture key), so a generate joins the
+#task a background ingest already started instead of rendering the capture twice
+_capture_tasks = {}
+_capture_tasks_lock = threading.Lock()
+
+#any change to the effect code invalidates every cached output
+CODE_VERSION = file_digest(image_processing.__file__, presets.__file__)
+
+
+def available_effects():
+    #the configured effects the pipeline renders, anything not in EFFECTS is skipped
+    return [ x for x in settings.get("AVAILABLE_EFFECT", []) if x in EFFECTS ]
+
+
+#reported up front, a job waiting for an effect that is never rendered would never finish
+_unknown_effects = [ x for x in settings.get("AVAILABLE_EFFECT", []) if x not in EFFECTS ]
+if _unknown_effects:
+    config_errors.append(f"AVAILABLE_EFFECT: unknown effects {', '.join(_unknown_effects)}, expected some of {', '.join(EFFECTS)}")
+
+
+def init_worker(frame_base_dir, worker_ready):
+    global _worker_ready
+    _worker_ready = worker_ready
+    warm_worker(frame_base_dir)
+
+
+def get_worker_pool():
+    #one pool per server process, shared by every request
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            logging.info(f"Starting worker pool with {settings['WORKER_POOL_SIZE']} workers")
+            _worker_pool = ProcessPoolExecutor(
+                max_workers=settings["WORKER_POOL_SIZE"],
+                mp_context=_mp_context,
+                initializer=init_worker,
+                initargs=(settings["IMG_FRAME_BASE_DIR"], _mp_context.Barrier(settings["WORKER_POOL_SIZE"]))
+            )
+    return _worker_pool
+
+
+def shutdown_worker_pool():
+    #waits for the tasks already submitted, a later get_worker_pool starts a new pool
+    global _worker_pool
+    with _worker_pool_lock:
+        pool, _worker_pool = _worker_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def worker_ready(fn=None):
+    #a worker waiting here takes no other task, so the pool has to start every worker
+    #and each one has run init_worker before any of these returns
+    _worker_ready.wait(WORKER_READY_TIMEOUT)
+    return os.getpid(), (fn() if fn is not None else None)
+
+
+def on_every_worker(fn=None):
+    #runs fn once in each worker, {pid: result}
+    pool = get_worker_pool()
+    tasks = [ pool.submit(worker_ready, fn) for _ in range(settings["WORKER_POOL_SIZE"]) ]
+    return dict(task.result() for task in tasks)
+
+
+def start_worker_pool():
+    #processes are only spawned when tasks arrive and have nothing to do before their
+    #first one, the pool only counts as started once every worker is warm
+    return len(on_every_worker())
+
+
+def render_capture(img_file_path, result_path, img_file, slot_size):
+    #runs in a pool worker, the timings go back to the parent with the result
+    with collect_timings() as timings:
+        with timed("decode"):
+            img_np = load_image(img_file_path)
+        with timed("face_detect"):
+            faces = find_faces(img_np)
+        apply_all_effect(img_np, result_path, img_file, slot_size, faces)
+    #faces are found once per capture; with mixed slot sizes the crop happens per slot in stage 2
+    return (faces if slot_size is None else None), timings
+
+
+def render_effect(effect_path, frame_id, frame_base_dir, faces=None, compile=True, animate=True):
+    #compiled.jpg depends on the frame, the animations only on the captures
+    with collect_timings(effect=os.path.basename(effect_path)) as timings:
+        #the captures are decoded once and shared by the compiled frame and the animations
+        with timed("decode"):
+            images = load_captures(effect_path)
+
+        if compile:
+            if faces:
+                faces = [ faces.get(x) for x in list_captures(effect_path) ]
+            compiled_np = compile_frame(
+                frame_id=frame_id,
+                src_img_path=effect_path,
+                frame_base_dir=frame_base_dir,
+                images=images,
+                faces=faces
+            )
+            with timed("save_image"):
+                save_image(compiled_np, os.path.join(effect_path, "compiled.jpg"))
+            #a print-ready image of the previous frame must never be printed for this one.
+            #removed after compiled.jpg is replaced, a print render finishing later sees
+            #the new compiled.jpg and drops its own result
+            remove_file(os.path.join(effect_path, "print.jpg"))
+
+        if animate:
+            generate_animations(
+                images,
+                os.path.join(effect_path, "compiled"),
+                delay=0.7
+            )
+    return timings
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def render_print(effect_path, print_size):
+    #written under a temporary name so the spooler never picks up a partial file, and
+    #stamped with the compiled.jpg it was made from: if a generate replaced compiled.jpg
+    #meanwhile the result belongs to the previous frame and is dropped
+    compiled_path = os.path.join(effect_path, "compiled.jpg")
+    print_path = os.path.join(effect_path, "print.jpg")
+    with collect_timings(effect=os.path.basename(effect_path)) as timings:
+        with timed("print_render"):
+            stamp = file_stat(compiled_path)
+            np_img = load_image(compiled_path)
+            tmp_path = os.path.join(effect_path, f".print.jpg.{os.getpid()}.tmp")
+            save_print_image(fit_print_size(np_img, print_size), tmp_path)
+            if file_stat(compiled_path) != stamp:
+                os.remove(tmp_path)
+                logging.info(f"Dropped a stale print image of {effect_path}")
+                return timings
+            os.replace(tmp_path, print_path)
+            #compiled.jpg may have been replaced between the check and the rename
+            if file_stat(compiled_path) != stamp:
+                remove_file(print_path)
+    return timings
+
+
+def on_print_rendered(task):
+    if task.exception() is not None:
+        logging.error(f"Cannot render print image: {task.exception()}")
+    else:
+        observe_all(task.result())
+
+
+def order_effects(effects):
+    #the UI shows light_original first
+    effects = list(effects)
+    if "light_original" in effects:
+        effects.insert(0, effects.pop(effects.index("light_original")))
+    return effects
+
+
+def capture_params(slot_size):
+    #everything besides the source bytes that a capture's effect outputs depend on
+    return {
+        "effects": available_effects(),
+        "slot_size": list(slot_size) if slot_size is not None else None,
+        "face_aware_crop": settings["FACE_AWARE_CROP"],
+        "face_detect_size": settings["FACE_DETECT_SIZE"],
+        "intermediate_format": settings["INTERMEDIATE_FORMAT"],
+        "code": CODE_VERSION
+    }
+
+
+def frame_params(frame_id):
+    #everything besides the effect captures that compiled.jpg depends on
+    frame_base_dir = settings["IMG_FRAME_BASE_DIR"]
+    frame_name = f"frame-{frame_id}.png"
+    return {
+        "frame_id": frame_id,
+        "frame": file_stat(os.path.join(frame_base_dir, frame_name)),
+        "layout": get_frame_layout(frame_base_dir, frame_name),
+        "code": CODE_VERSION
+    }
+
+
+def animation_params():
+    #the animations don't depend on the frame, switching frames leaves them alone
+    return {
+        "animation_formats": settings["ANIMATION_FORMATS"],
+        "animation_max_size": settings["ANIMATION_MAX_SIZE"],
+        "code": CODE_VERSION
+    }
+
+
+def session_params(frame_id):
+    #everything besides the sources that a whole session's outputs depend on
+    slot_size = get_slot_size(settings["IMG_FRAME_BASE_DIR"], f"frame-{frame_id}.png")
+    return {**frame_params(frame_id), "captures": capture_params(slot_size), "animations": animation_params()}
+
+
+def is_up_to_date(entry, key, outputs):
+    return entry.get("key") == key and all(os.path.exists(x) for x in outputs)
+
+
+def submit_capture(pool, source_path, result_path, img_file, slot_size, key):
+    #returns the task and whether this caller submitted it, only the submitter reports its timings
+    with _capture_tasks_lock:
+        task = _capture_tasks.get((result_path, img_file, key))
+        if task is not None:
+            return task, False
+        #the output name is decided here, the workers may run with an older config
+        task = pool.submit(render_capture, os.path.join(source_path, img_file), result_path, capture_name(img_file), slot_size)
+        _capture_tasks[(result_path, img_file, key)] = task
+
+    def forget(task):
+        with _capture_tasks_lock:
+            _capture_tasks.pop((result_path, img_file, key), None)
+    task.add_done_callback(forget)
+    return task, True
+
+
+def prepare_captures(tx_id, frame_id, collect=None):
+    #stage 1: one task per capture, each decodes and resizes once and renders every effect.
+    #returns the source hashes, the capture keys and the face boxes of every capture
+    source_path = source_dir(tx_id)
+    result_path = result_dir(tx_id)
+    storage.touch(tx_id)
+    pool = get_worker_pool()
+    effects = available_effects()
+
+    for effect in effects:
+        os.makedirs(f"{result_path}/{effect}", exist_ok=True)
+
+    slot_size = get_slot_size(settings["IMG_FRAME_BASE_DIR"], f"frame-{frame_id}.png")
+    params = capture_params(slot_size)
+
+    #the manifest records what every output was made from, a stage only runs when its inputs changed
+    with locked_manifest(result_path) as manifest:
+        sources = source_hashes(source_path, manifest["sources"])
+        for img_file in list(manifest["captures"]):
+            #a capture that was deleted from the source must not stay in the frame, nor
+            #one written under another name before INTERMEDIATE_FORMAT changed
+            output = manifest["captures"][img_file].get("output", img_file)
+            if img_file in sources and output == capture_name(img_file):
+                continue
+            for effect in effects:
+                if os.path.exists(os.path.join(result_path, effect, output)):
+                    os.remove(os.path.join(result_path, effect, output))
+            del manifest["captures"][img_file]
+        manifest["sources"] = sources
+
+        capture_keys = { img_file: digest({"source": x["sha1"], **params}) for img_file, x in sources.items() }
+        stale_captures = [
+            img_file for img_file in sources
+            if manifest["captures"].get(img_file, {}).get("key") != capture_keys[img_file]
+            or not all(os.path.exists(os.path.join(result_path, effect, capture_name(img_file))) for effect in effects)
+        ]
+        logging.info(f"Applying filter for {len(stale_captures)} of {len(sources)} {tx_id} images")
+        capture_tasks = {
+            img_file: submit_capture(pool, source_path, result_path, img_file, slot_size, capture_keys[img_file])
+            for img_file in stale_captures
+        }
+
+    for img_file, (task, submitted) in capture_tasks.items():
+        faces, records = task.result()
+        with locked_manifest(result_path) as manifest:
+            manifest["captures"][img_file] = {"key": capture_keys[img_file], "output": capture_name(img_file), "faces": faces}
+        if submitted and collect is not None:
+            collect(records)
+
+    with locked_manifest(result_path) as manifest:
+        #keyed by the effect capture name, that is what stage 2 lists
+        faces = { capture_name(img_file): manifest["captures"][img_file]["faces"] for img_file in sources }
+    return sources, capture_keys, faces
+
+
+def prepare_in_background(tx_id, frame_id):
+    #speculative stage 1 while the guest is still busy, generate joins whatever is still running
+    def run():
+        try:
+            prepare_captures(tx_id, frame_id, lambda records: observe_all([ {**x, "frame_id": frame_id} for x in records ]))
+        except Exception as e:
+            logging.error(f"Cannot prepare {tx_id} captures: {e}", exc_info=True)
+
+    threading.Thread(target=run, name=f"prepare-{tx_id}", daemon=True).start()
+
+
+def iter_session(tx_id, frame_id, timings=None):
+    #yields each effect once its compiled.jpg and compiled.gif exist, in order_effects order for the first one.
+    #the stage timings of every task are aggregated here, and also appended to timings if given
+    def collect(records):
+        records = [ {**x, "frame_id": frame_id} for x in records ]
+        observe_all(records)
+        if timings is not None:
+            timings.extend(records)
+
+    start = time.perf_counter()
+    result_path = result_dir(tx_id)
+    pool = get_worker_pool()
+    effects = available_effects()
+    sources, capture_keys, faces = prepare_captures(tx_id, frame_id, collect)
+    with locked_manifest(result_path) as manifest:
+        effect_entries = dict(manifest["effects"])
+
+    #stage 2: one task per effect, each needs every capture of that effect.
+    #the first effect is submitted first and the others are held back until it is out
+    effect_dirs = order_effects(effects)
+    captures = [ capture_keys[x] for x in sorted(sources) ]
+    compiled_key = digest({"captures": captures, **frame_params(frame_id)})
+    animation_key = digest({"captures": captures, **animation_params()})
+    stale = {}
+    for effect in effect_dirs:
+        effect_path = os.path.join(result_path, effect)
+        entry = effect_entries.get(effect, {})
+        compile = not is_up_to_date(entry.get("compiled", {}), compiled_key, [os.path.join(effect_path, "compiled.jpg")])
+        animate = not is_up_to_date(entry.get("animations", {}), animation_key, [
+            os.path.join(effect_path, f"compiled.{x}") for x in settings["ANIMATION_FORMATS"]
+        ])
+        if compile or animate:
+            stale[effect] = (compile, animate)
+    logging.info(f"Compiling {len(stale)} of {len(effect_dirs)} effects for {tx_id}")
+    effect_tasks = {
+        pool.submit(render_effect, os.path.join(result_path, effect), frame_id, settings["IMG_FRAME_BASE_DIR"], faces, *stale[effect]): effect
+        for effect in effect_dirs if effect in stale
+    }
+
+    def prerender_print(effect):
+        #print-ready images queue up behind the remaining effects and nobody waits for them
+        if settings["PRINT_PRERENDER"] and settings["PRINT_SIZE"]:
+            if stale.get(effect, (False,))[0] or not os.path.exists(os.path.join(result_path, effect, "print.jpg")):
+                print_task = pool.submit(render_print, os.path.join(result_path, effect), settings["PRINT_SIZE"])
+                print_task.add_done_callback(on_print_rendered)
+
+    held = []
+    for effect in effect_dirs:
+        if effect not in stale:
+            prerender_print(effect)
+            held.append(effect)
+    first_done = effect_dirs[0] in held
+    if first_done:
+        yield from held
+        held = []
+
+    for task in as_completed(effect_tasks):
+        collect(task.result())
+        effect = effect_tasks[task]
+        with locked_manifest(result_path) as manifest:
+            manifest["effects"][effect] = {"compiled": {"key": compiled_key}, "animations": {"key": animation_key}}
+        prerender_print(effect)
+        held.append(effect)
+        first_done = first_done or effect_dirs[0] in held
+        if first_done:
+            held.sort(key=effect_dirs.index)
+            yield from held
+            held = []
+
+    collect([{"stage": "session", "seconds": time.perf_counter() - start}])
+
+
+def generate_session(tx_id, frame_id, on_effect_done=None, timings=None):
+    effects = []
+    for effect in iter_session(tx_id, frame_id, timings):
+        effects.append(effect)
+        if on_effect_done is not None:
+            on_effect_done(effect)
+    return effects
@@ -0,0 +1,174 @@
+import math
+import cv2
+import numpy as np
+
+
+#All filters treat the three channels alike, so kernels run on BGR buffers as-is.
+#Rounding follows fimage (truncate, then clip to 0..255) so existing looks are kept.
+IDENTITY_LUT = np.arange(256, dtype=np.uint8)
+
+
+def constrain(values):
+  return np.clip(np.asarray(values).astype(np.int16), 0, 255).astype(np.uint8)
+
+
+class Filter:
+  #per-channel filters map a channel value to a new value and fold into a LUT
+  per_channel = True
+
+  def lookup(self, lut):
+    raise NotImplementedError
+
+
+class Brightness(Filter):
+  def __init__(self, adjust=0):
+    self.adjust = math.floor(255 * (adjust / 100))
+
+  def lookup(self, lut):
+    return constrain(lut.astype(np.int16) + self.adjust)
+
+
+class Contrast(Filter):
+  def __init__(self, adjust=100):
+    self.adjust = math.pow((adjust + 100) / 100, 2)
+
+  def lookup(self, lut):
+    values = lut / 255
+    values -= 0.5
+    values *= self.adjust
+    values += 0.5
+    values *= 255
+    return constrain(values)
+
+
+class Gamma(Filter):
+  def __init__(self, adjust=1.0):
+    self.adjust = adjust
+
+  def lookup(self, lut):
+    return constrain(((lut / 255) ** self.adjust) * 255)
+
+
+class Curves(Filter):
+  def __init__(self, p0, p1, p2, p3, granuality=1000):
+    self.curve = self.calculate_bezier(p0, p1, p2, p3, granuality)
+
+  def calculate_bezier(self, p0, p1, p2, p3, granuality):
+    curve = {}
+    for i in range(granuality):
+      t = i / granuality
+      x = (1 - t) ** 3 * p0[0] + 3 * (1 - t) ** 2 * t * p1[0] + 3 * (1 - t) * t ** 2 * p2[0] + t ** 3 * p3[0]
+      y = (1 - t) ** 3 * p0[1] + 3 * (1 - t) ** 2 * t * p1[1] + 3 * (1 - t) * t ** 2 * p2[1] + t ** 3 * p3[1]
+      curve[round(x)] = round(min(max(y, 0), 255))
+
+    #fill the x values the curve skipped over
+    for index in range(256):
+      if index in curve:
+        continue
+      left = curve.get(index - 1)
+      right = next((curve[i] for i in range(index, 256) if i in curve), None)
+      if left is not None and right is not None:
+        curve[index] = round((left + right) / 2)
+      else:
+        curve[index] = right if left is None else left
+
+    return np.array([curve[i] for i in range(256)], dtype=np.uint8)
+
+  def lookup(self, lut):
+    return self.curve[lut]
+
+
+class Exposure(Curves):
+  def __init__(self, adjust=1):
+    adjust = abs(adjust) / 100
+    super().__init__((0, 0), (0, adjust * 255), (255 - (adjust * 255), 255), (255, 255))
+
+
+class Saturation(Filter):
+  per_channel = False
+  #depends only on the channel and the pixel max, so input LUTs can be folded in
+  max_channel = True
+
+  def __init__(self, adjust=0):
+    self.adjust = adjust * -0.01
+
+  def table(self):
+    max_value, value = np.meshgrid(IDENTITY_LUT, IDENTITY_LUT, indexing="ij")
+    return constrain(value + (max_value - value) * self.adjust)
+
+  def index(self, np_img):
+    max_img = np.left_shift(np_img.max(axis=2, keepdims=True), 8, dtype=np.uint16)
+    return np.bitwise_or(max_img, np_img, dtype=np.uint16)
+
+
+class Vibrance(Filter):
+  per_channel = False
+  max_channel = False
+
+  def __init__(self, adjust=0):
+    self.adjust = adjust * -1
+
+  def table(self):
+    #indexed by (spread / 2, max, channel); spread only takes even values
+    spread, max_value, value = np.meshgrid(
+      np.arange(0, 256, 2), np.arange(256), np.arange(256), indexing="ij"
+    )
+    amount = ((spread / 255) * self.adjust) / 100
+    return constrain(value + (max_value - value) * amount)
+
+  def index(self, np_img):
+    max_img = np_img.max(axis=2)
+    #fimage averages with a uint8 accumulator, keep its wrap-around so the look is unchanged
+    avg_img = (np_img.sum(axis=2, dtype=np.uint16) % 256 // 3).astype(np.uint8)
+    spread = (max_img - avg_img) * np.uint8(2)
+    index = np.left_shift(spread >> 1, 16, dtype=np.uint32)
+    index |= np.left_shift(max_img, 8, dtype=np.uint32)
+    return np.bitwise_or(index[..., None], np_img, dtype=np.uint32)
+
+
+class Preset:
+  filters = []
+
+  @classmethod
+  def compile(cls):
+    #fold runs of per-channel filters into one LUT, fold monotonic LUTs into the
+    #input of max-channel tables and any trailing LUT into the table output
+    stages = []
+    lut = IDENTITY_LUT
+    for filter_ in cls.filters:
+      if filter_.per_channel:
+        lut = filter_.lookup(lut)
+        continue
+
+      if filter_.max_channel and np.all(np.diff(lut.astype(np.int16)) >= 0):
+        stages.append(["table", filter_, filter_.table()[lut[:, None], lut[None, :]]])
+      else:
+        stages.extend([["lut", None, lut], ["table", filter_, filter_.table()]])
+      lut = IDENTITY_LUT
+    stages.append(["lut", None, lut])
+
+    #a LUT following a table is folded into the table output
+    kernel = []
+    for stage, filter_, values in stages:
+      if stage == "lut" and kernel and kernel[-1][0] == "table":
+        kernel[-1][2] = values[kernel[-1][2]]
+      elif stage == "lut" and np.array_equal(values, IDENTITY_LUT):
+        continue
+      else:
+        kernel.append([stage, filter_, values])
+    return kernel
+
+  @classmethod
+  def kernel(cls):
+    if "_kernel" not in cls.__dict__:
+      cls._kernel = cls.compile()
+    return cls._kernel
+
+  @classmethod
+  def process(cls, np_img):
+    for stage, filter_, values in cls.kernel():
+      if stage == "lut":
+        np_img = cv2.LUT(np_img, values)
+      else:
+        np_img = np.take(values.ravel(), filter_.index(np_img))
+    return np_img
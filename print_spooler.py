@@ -0,0 +1,212 @@
+import os
+import sys
+import time
+import uuid
+import queue
+import shutil
+import logging
+import threading
+from config import app, config_errors
+from metrics import timed
+
+
+class DirectoryPrinter:
+    #a hotfolder is a directory the printer software watches, a plain local
+    #directory works the same way and stands in for a printer in tests
+    def __init__(self, path, max_pending=0, poll_interval=0.5):
+        self.path = path
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+
+    def pending_files(self):
+        return [ x for x in os.listdir(self.path) if not x.startswith(".") ]
+
+    def print_file(self, img_file, job_name):
+        os.makedirs(self.path, exist_ok=True)
+        #don't fill the hotfolder faster than the printer empties it
+        while self.max_pending and len(self.pending_files()) >= self.max_pending:
+            time.sleep(self.poll_interval)
+
+        #the printer software must never pick up a half-written file
+        tmp_path = os.path.join(self.path, f".{job_name}.tmp")
+        with timed("hotfolder_copy"):
+            shutil.copyfile(img_file, tmp_path)
+            os.replace(tmp_path, os.path.join(self.path, job_name))
+
+
+class Win32Printer:
+    def __init__(self, printer_name):
+        self.printer_name = printer_name
+
+    def print_file(self, img_file, job_name):
+        #pywin32 is only needed, and only available, on the Windows booth PCs
+        from printer_utils import get_device_context, get_printer_name, print_image
+        #print.jpg is already in the paper orientation
+        rotate = os.path.basename(img_file) != "print.jpg"
+        with timed("print_image"):
+            print_image(img_file, get_device_context(self.printer_name or get_printer_name()), rotate)
+
+
+class PrintJob:
+    def __init__(self, printer, tx_id, effect, img_file):
+        self.job_id = uuid.uuid4().hex
+        self.printer = printer
+        self.tx_id = tx_id
+        self.effect = effect
+        self.img_file = img_file
+        self.status = "queued"
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "printer": self.printer,
+            "tx_id": self.tx_id,
+            "effect": self.effect,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+
+class PrintSpooler:
+    def __init__(self, printers, dedup_seconds, history_size=500):
+        self.printers = printers
+        self.dedup_seconds = dedup_seconds
+        self.history_size = history_size
+        self.queues = { x: queue.Queue() for x in printers }
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for printer_name in self.printers:
+                worker = threading.Thread(target=self.run_worker, args=[printer_name], name=f"print-{printer_name}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def find_duplicate(self, printer_name, tx_id, effect):
+        #a double tap re-uses the job still in flight or printed moments ago
+        for job in self.jobs.values():
+            if (job.printer, job.tx_id, job.effect) != (printer_name, tx_id, effect):
+                continue
+            if job.status in ["queued", "printing"]:
+                return job
+            if job.status == "done" and time.time() - job.finished_at < self.dedup_seconds:
+                return job
+        return None
+
+    def submit(self, printer_name, tx_id, effect, img_file):
+        #without a printer name the first configured printer is used
+        printer_name = printer_name or next(iter(self.printers), None)
+        if printer_name is None:
+            raise ValueError("No printer configured, printing is disabled")
+        if printer_name not in self.printers:
+            raise ValueError(f"Unknown printer {printer_name}")
+        if not os.path.isfile(img_file):
+            raise FileNotFoundError(f"{img_file} does not exist")
+
+        self.start()
+        with self.lock:
+            job = self.find_duplicate(printer_name, tx_id, effect)
+            if job is not None:
+                return job, True
+            job = PrintJob(printer_name, tx_id, effect, img_file)
+            self.jobs[job.job_id] = job
+            self.prune()
+        self.queues[printer_name].put(job)
+        return job, False
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.created_at)
+
+    def prune(self):
+        finished = [ job for job in self.jobs.values() if job.finished_at is not None ]
+        for job in sorted(finished, key=lambda job: job.finished_at)[:len(self.jobs) - self.history_size]:
+            del self.jobs[job.job_id]
+
+    def drain(self, timeout):
+        #wait for queued and printing jobs, false if they did not finish in time
+        deadline = time.time() + timeout
+        for printer_queue in self.queues.values():
+            with printer_queue.all_tasks_done:
+                while printer_queue.unfinished_tasks:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    printer_queue.all_tasks_done.wait(remaining)
+        return True
+
+    def run_worker(self, printer_name):
+        printer = self.printers[printer_name]
+        while True:
+            job = self.queues[printer_name].get()
+            job.status = "printing"
+            try:
+                printer.print_file(job.img_file, f"{job.tx_id}-{job.effect}-{job.job_id[:8]}{os.path.splitext(job.img_file)[1]}")
+                job.status = "done"
+            except Exception as e:
+                logging.error(f"Print job {job.job_id} failed: {e}", exc_info=True)
+                job.error = f"{e}"
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                self.queues[printer_name].task_done()
+
+
+def create_printer(printer_config):
+    backend = printer_config.get("backend", "hotfolder")
+    if backend in ["hotfolder", "directory"]:
+        return DirectoryPrinter(printer_config["path"], printer_config.get("max_pending", 0))
+    if backend == "win32":
+        #pywin32 only exists on Windows, elsewhere the booth prints through a hotfolder
+        if sys.platform != "win32":
+            raise ValueError("The win32 printer backend is only available on Windows, use a hotfolder")
+        return Win32Printer(printer_config.get("printer_name"))
+    raise ValueError(f"Unknown printer backend {backend}")
+
+
+def default_printer_config():
+    if app.config["HOTFOLDER_PATH_PRINT"] is not None:
+        return {"backend": "hotfolder", "path": app.config["HOTFOLDER_PATH_PRINT"]}
+    if sys.platform == "win32":
+        return {"backend": "win32", "printer_name": app.config.get("PRINTER_NAME")}
+    return None
+
+
+def load_printers():
+    #PRINTERS maps a printer name to {backend, path, max_pending, printer_name};
+    #without it the HOTFOLDER_PATH_PRINT hotfolder is the default printer, or on
+    #Windows the PRINTER_NAME printer. A plain directory is only used when PRINTERS
+    #asks for one, printing must never report done when nothing was printed
+    printers_config = app.config["PRINTERS"]
+    if not printers_config:
+        default_config = default_printer_config()
+        if default_config is None:
+            logging.error("No printer configured, printing is disabled")
+            config_errors.append("No printer configured, set PRINTERS or HOTFOLDER_PATH_PRINT")
+            return {}
+        printers_config = {"default": default_config}
+    printers = {}
+    for name, printer_config in printers_config.items():
+        #one misconfigured printer must not keep the others, or the server, from starting
+        try:
+            printers[name] = create_printer(printer_config)
+        except (KeyError, ValueError) as e:
+            logging.error(f"Printer {name} is disabled: {e}")
+            config_errors.append(f"PRINTERS.{name}: {e}")
+    return printers
+
+
+print_spooler = PrintSpooler(load_printers(), app.config["PRINT_DEDUP_SECONDS"])
@@ -1,6 +1,6 @@
 import win32print
 import win32ui
-import shutil
+import logging
 from PIL import Image, ImageWin
 from config import app_config
 
@@ -20,20 +20,21 @@ def get_device_context(printer_name):
     hDC.CreatePrinterDC(printer_name)
     return hDC
 
-def print_image(img_file, device_context):
+def print_image(img_file, device_context, rotate=True):
     #load image
     bmp = Image.open(img_file)
-    bmp = bmp.rotate(90)
+    if rotate:
+        bmp = bmp.rotate(90, expand=True)
 
     #set printer device-context config
     printer_conf = load_printer_config()
     printable_area = device_context.GetDeviceCaps(printer_conf['HOZRES'].get(int)), device_context.GetDeviceCaps(printer_conf['VERTRES'].get(int))
-    print(printable_area)
+    logging.debug(f"Printable area: {printable_area}")
     printer_size = device_context.GetDeviceCaps(printer_conf['PHYSICALWIDTH'].get(int)), device_context.GetDeviceCaps(printer_conf['PHYSICALHEIGHT'].get(int))
-    print(printer_size)
+    logging.debug(f"Printer size: {printer_size}")
     ratios = [1.0 * printable_area[0] / bmp.size[0], 1.0 * printable_area[1] / bmp.size[1]]
     scale = min(ratios)
-    print(scale)
+    logging.debug(f"Scale: {scale}")
 
     try:
         device_context.StartDoc(img_file)
@@ -44,7 +45,7 @@ def print_image(img_file, device_context):
         y1 = int((printer_size[1] - scaled_height) / 2)
         x2 = x1 + scaled_width
         y2 = y1 + scaled_height
-        print((x1,y1),(x2,y2))
+        logging.debug(f"Drawing at {(x1, y1)}, {(x2, y2)}")
         dib.draw (device_context.GetHandleOutput(), (x1, y1, x2, y2))
         device_context.EndPage()
         device_context.EndDoc()
@@ -52,7 +53,3 @@ def print_image(img_file, device_context):
     except Exception as e:
         raise e
 
-
-def print_image_hotfolder(img_file):
-    dest = app_config["HOTFOLDER_PATH_PRINT"].get()
-    shutil.copy(img_file, dest)
@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import fnmatch
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def match_sessions(src_base_dir, patterns):
+    #tx_ids are matched against the source directories, they are what is rendered
+    tx_ids = sorted(x for x in os.listdir(src_base_dir) if os.path.isdir(os.path.join(src_base_dir, x)) and not x.startswith("."))
+    matched = []
+    for pattern in patterns:
+        matched.extend(x for x in fnmatch.filter(tx_ids, pattern) if x not in matched)
+    return matched
+
+
+def read_journal(journal_path, render_key):
+    #sessions already rendered with these inputs by an earlier, possibly interrupted, run.
+    #render_key covers the frame file, its layout and the capture and animation settings,
+    #so a frame changed again since that run renders every session again
+    done, stale = set(), set()
+    if not os.path.exists(journal_path):
+        return done, stale
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                #the last line of a run that was killed mid-write
+                continue
+            if entry.get("status") != "done":
+                continue
+            if entry.get("render_key") == render_key:
+                done.add(entry["tx_id"])
+            else:
+                stale.add(entry["tx_id"])
+    return done, stale - done
+
+
+class Journal:
+    def __init__(self, journal_path):
+        self.file = open(journal_path, "a")
+        self.lock = threading.Lock()
+
+    def write(self, entry):
+        #one line per session, flushed so an interrupted run resumes where it stopped
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def throughput(results, elapsed):
+    done = [ x for x in results if x["status"] == "done" ]
+    captures = sum(x["captures"] for x in done)
+    return {
+        "sessions": len(results),
+        "done": len(done),
+        "failed": len(results) - len(done),
+        "seconds": round(elapsed, 2),
+        "sessions_per_minute": round(60.0 * len(done) / elapsed, 2) if elapsed else None,
+        "captures_per_second": round(captures / elapsed, 2) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render many sessions again, e.g. after a frame or preset changed")
+    parser.add_argument("tx_ids", nargs="*", help="tx_ids or glob patterns, e.g. '2024-06-*'")
+    parser.add_argument("--frame-id", required=True)
+    parser.add_argument("--tx-file", help="read more tx_ids or patterns from this file, one per line")
+    parser.add_argument("--config", help="config file (default: CONFIG_PATH)")
+    parser.add_argument("--workers", type=int, help="worker processes (default: WORKER_POOL_SIZE)")
+    parser.add_argument("--sessions", type=int, default=2, help="sessions rendered at once, their captures and effects share the workers")
+    parser.add_argument("--journal", default="regenerate-journal.jsonl", help="progress journal, finished sessions are skipped when it is run again")
+    parser.add_argument("--restart", action="store_true", help="ignore the journal and render every session")
+    args = parser.parse_args()
+
+    patterns = list(args.tx_ids)
+    if args.tx_file:
+        with open(args.tx_file) as f:
+            patterns.extend(x.strip() for x in f if x.strip())
+    if not patterns:
+        parser.error("no tx_ids given")
+    if args.config:
+        os.environ["CONFIG_PATH"] = args.config
+
+    #the pipeline reads plain settings, the Flask app is never created
+    from settings import settings, config_errors
+    if args.workers:
+        settings["WORKER_POOL_SIZE"] = args.workers
+    import pipeline
+    for x in config_errors:
+        print(f"Configuration: {x}", file=sys.stderr)
+    from storage import source_dir
+
+    from manifest import digest
+
+    tx_ids = match_sessions(settings["IMG_SRC_BASE_DIR"], patterns)
+    render_key = digest(pipeline.session_params(args.frame_id))
+    done, stale = (set(), set()) if args.restart else read_journal(args.journal, render_key)
+    pending = [ x for x in tx_ids if x not in done ]
+    stale = [ x for x in pending if x in stale ]
+    if args.restart:
+        print(f"{len(tx_ids)} sessions matched, journal ignored (--restart)", file=sys.stderr)
+    else:
+        print(f"{len(tx_ids)} sessions matched, skipping {len(tx_ids) - len(pending)} already rendered with these frame, layout and effect settings; "
+              f"{len(stale)} journaled sessions are rendered again because their frame, layout or settings changed", file=sys.stderr)
+    print(f"Rendering {len(pending)} sessions with {settings['WORKER_POOL_SIZE']} workers", file=sys.stderr)
+
+    def render(tx_id):
+        start = time.perf_counter()
+        try:
+            effects = pipeline.generate_session(tx_id, args.frame_id)
+            captures = len([ x for x in os.listdir(source_dir(tx_id)) if not x.startswith(".") ])
+            return {"tx_id": tx_id, "frame_id": args.frame_id, "status": "done", "effects": len(effects), "captures": captures, "seconds": round(time.perf_counter() - start, 3)}
+        except Exception as e:
+            return {"tx_id": tx_id, "frame_id": args.frame_id, "status": "failed", "error": f"{e}", "captures": 0, "seconds": round(time.perf_counter() - start, 3)}
+
+    journal = Journal(args.journal)
+    executor = ThreadPoolExecutor(max_workers=args.sessions)
+    results = []
+    start = time.perf_counter()
+    try:
+        if pending:
+            pipeline.start_worker_pool()
+        tasks = [ executor.submit(render, x) for x in pending ]
+        for task in as_completed(tasks):
+            result = task.result()
+            journal.write({**result, "code": pipeline.CODE_VERSION, "render_key": render_key, "finished_at": time.time()})
+            results.append(result)
+            elapsed = time.perf_counter() - start
+            line = f"[{len(results)}/{len(pending)}] {result['tx_id']} {result['status']} in {result['seconds']}s"
+            if result["status"] == "failed":
+                line += f": {result['error']}"
+            print(f"{line} ({throughput(results, elapsed)['sessions_per_minute']} sessions/min)", file=sys.stderr)
+    except KeyboardInterrupt:
+        #sessions not in the journal yet are rendered again on the next run, the
+        #manifest skips whatever they already finished
+        print("Interrupted, run the same command again to resume", file=sys.stderr)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        journal.close()
+        pipeline.shutdown_worker_pool()
+
+    summary = throughput(results, time.perf_counter() - start)
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import os
+import logging
+import threading
+from functools import lru_cache
+import cv2
+import numpy as np
+from PIL import Image, ImageSequence
+from flask import send_file
+from werkzeug.security import safe_join
+from config import app
+from metrics import timed
+from manifest import file_digest
+from storage import storage, result_dir
+from image_processing import generate_gif, generate_webp
+
+THUMBNAIL_DIR = ".thumbs"
+#outputs requested with their current ?v= never change under that URL
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+#stills are thumbnailed to JPEG, animations keep their format
+THUMBNAIL_FORMATS = {
+    ".jpg": ".jpg",
+    ".jpeg": ".jpg",
+    ".png": ".jpg",
+    ".gif": ".gif",
+    ".webp": ".webp",
+}
+ANIMATION_WRITERS = {
+    ".gif": generate_gif,
+    ".webp": generate_webp,
+}
+
+
+@lru_cache(maxsize=4096)
+def content_etag(path, size, mtime_ns):
+    #strong validator, a file is only hashed again once it changed on disk
+    return file_digest(path)
+
+
+def result_etag(path):
+    stat = os.stat(path)
+    return content_etag(path, stat.st_size, stat.st_mtime_ns)
+
+
+def result_version(path):
+    try:
+        return result_etag(path)[:12]
+    except FileNotFoundError:
+        return None
+
+
+def result_path(tx_id, effect, filename):
+    #dot files are thumbnails and outputs still being written
+    if filename.startswith(".") or safe_join(app.config["IMG_RESULT_BASE_DIR"], tx_id) is None:
+        return None
+    storage.touch(tx_id)
+    return safe_join(result_dir(tx_id), effect, filename)
+
+
+def result_url(base_url, tx_id, effect, filename):
+    #the content version in the URL lets clients cache the output for good,
+    #a regenerated output gets a new URL
+    url = f"{base_url}/static/res_image/{tx_id}/{effect}/{filename}"
+    version = result_version(os.path.join(result_dir(tx_id), effect, filename))
+    return url if version is None else f"{url}?v={version}"
+
+
+def thumbnail_width(width):
+    #widths snap up to a configured size so ?w= cannot fill the disk with variants
+    for x in sorted(app.config["THUMBNAIL_WIDTHS"]):
+        if width <= x:
+            return x
+    return None
+
+
+def thumbnail_path(path, etag, width):
+    name, ext = os.path.splitext(os.path.basename(path))
+    return os.path.join(os.path.dirname(path), THUMBNAIL_DIR, f"{name}.{etag[:12]}.w{width}{THUMBNAIL_FORMATS[ext.lower()]}")
+
+
+def resize_to_width(np_img, width):
+    height = max(1, int(round(np_img.shape[0] * width / float(np_img.shape[1]))))
+    return cv2.resize(np_img, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def render_thumbnail(path, thumb_path, width):
+    ext = os.path.splitext(path)[1].lower()
+    #unique per thread, two requests for the same thumbnail both render and the last rename wins
+    tmp_path = os.path.join(os.path.dirname(thumb_path), f".{os.path.basename(thumb_path)}.{threading.get_ident()}.tmp")
+    if ext in ANIMATION_WRITERS:
+        with Image.open(path) as img:
+            frames = [ cv2.cvtColor(np.asarray(x.convert("RGB")), cv2.COLOR_RGB2BGR) for x in ImageSequence.Iterator(img) ]
+            delay = img.info.get("duration", 1000) / 1000.0
+        frames = [ resize_to_width(x, width) for x in frames ]
+        ANIMATION_WRITERS[ext](frames, tmp_path, delay, max(frames[0].shape[:2]))
+    else:
+        np_img = cv2.imread(path, cv2.IMREAD_COLOR)
+        ok, buffer = cv2.imencode(".jpg", resize_to_width(np_img, width), [cv2.IMWRITE_JPEG_QUALITY, app.config["THUMBNAIL_QUALITY"]])
+        if not ok:
+            raise ValueError(f"Cannot encode a thumbnail of {path}")
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.tobytes())
+    os.replace(tmp_path, thumb_path)
+
+
+def get_thumbnail(path, width):
+    #rendered on first request and kept next to the output, keyed by its content
+    if os.path.splitext(path)[1].lower() not in THUMBNAIL_FORMATS:
+        return path
+    width = thumbnail_width(width)
+    if width is None:
+        return path
+    with Image.open(path) as img:
+        if img.width <= width:
+            return path
+
+    etag = result_etag(path)
+    thumb_path = thumbnail_path(path, etag, width)
+    if os.path.isfile(thumb_path):
+        return thumb_path
+
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    try:
+        with timed("thumbnail"):
+            render_thumbnail(path, thumb_path, width)
+    except Exception as e:
+        logging.error(f"Cannot render a thumbnail of {path}: {e}", exc_info=True)
+        return path
+
+    #thumbnails of an earlier version of the output only differ in the etag part
+    thumb_dir, thumb_name = os.path.split(thumb_path)
+    prefix = f"{os.path.splitext(os.path.basename(path))[0]}."
+    suffix = thumb_name[len(prefix) + 12:]
+    for x in os.listdir(thumb_dir):
+        if x != thumb_name and len(x) == len(thumb_name) and x.startswith(prefix) and x.endswith(suffix):
+            try:
+                os.remove(os.path.join(thumb_dir, x))
+            except FileNotFoundError:
+                pass
+    return thumb_path
+
+
+def send_result(path, version=None, width=None):
+    #If-None-Match and Range are answered by send_file from the strong content etag
+    immutable = version is not None and version == result_version(path)
+    if width:
+        path = get_thumbnail(path, width)
+    response = send_file(
+        path,
+        conditional=True,
+        etag=result_etag(path),
+        max_age=IMMUTABLE_MAX_AGE if immutable else None
+    )
+    if immutable:
+        response.cache_control.immutable = True
+    return response
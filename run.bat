@@ -5,6 +5,6 @@ echo "Initialize App Config..."
 set CONFIG_PATH=C:\Users\ADMIN\Desktop\config.yaml
 
 echo "Starting Python Photobooth Service..."
-python main.py
+python serve.py
 
 pause
\ No newline at end of file
@@ -1,12 +1,14 @@
 import os
+import base64
 import smtplib
+from functools import lru_cache
 from pathlib import Path
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import COMMASPACE, formatdate
-from email import encoders
 from config import app
+from storage import result_dir
 
 def generate_email_body(recipient):
     email_body = f"""
@@ -31,6 +33,28 @@ def generate_email_body(recipient):
     """
     return email_body
 
+def attachment_paths(tx_id, effect):
+    results_dir = result_dir(tx_id)
+    return [
+        os.path.join(results_dir, effect)+'/compiled.jpg',
+        os.path.join(results_dir, effect)+'/compiled.gif'
+    ]
+
+@lru_cache(maxsize=app.config["EMAIL_ATTACHMENT_CACHE_SIZE"])
+def encode_attachment(path, mtime, size):
+    #mtime and size are part of the key so a regenerated file is encoded again
+    with open(path, 'rb') as file:
+        return base64.encodebytes(file.read()).decode('ascii')
+
+def attachment_part(path):
+    stat = os.stat(path)
+    part = MIMEBase('application', "octet-stream")
+    part.set_payload(encode_attachment(path, stat.st_mtime, stat.st_size))
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition',
+                    'attachment; filename={}'.format(Path(path).name))
+    return part
+
 def compose_email(recipient_name, email, tx_id, effect):
     msg = MIMEMultipart('alternative')
     msg['From'] = app.config['EMAIL_USERNAME']
@@ -39,27 +63,14 @@ def compose_email(recipient_name, email, tx_id, effect):
     msg['Subject'] = f"ITS.SNAPLAB - Photos for {recipient_name}"
     message_body = generate_email_body(recipient_name)
 
-    results_dir = os.path.join(app.config["IMG_RESULT_BASE_DIR"], tx_id)
-    attached_files = [
-        os.path.join(results_dir, effect)+'/compiled.jpg',
-        os.path.join(results_dir, effect)+'/compiled.gif'
-    ]
-
     msg.attach(MIMEText(message_body, 'html'))
-    for path in attached_files:
-        part = MIMEBase('application', "octet-stream")
-        with open(path, 'rb') as file:
-            part.set_payload(file.read())
-        encoders.encode_base64(part)
-        part.add_header('Content-Disposition',
-                        'attachment; filename={}'.format(Path(path).name))
-        msg.attach(part)
+    for path in attachment_paths(tx_id, effect):
+        msg.attach(attachment_part(path))
     
     return msg
 
-def send_email(app, message, recipient_email, smtp_servername, smtp_serverport):
-    smtp = smtplib.SMTP(smtp_servername, smtp_serverport)
+def open_smtp(smtp_servername, smtp_serverport):
+    smtp = smtplib.SMTP(smtp_servername, smtp_serverport, timeout=60)
     smtp.starttls()
     smtp.login(app.config['EMAIL_USERNAME'], app.config['EMAIL_PASSWD'])
-    smtp.sendmail(app.config['EMAIL_USERNAME'], recipient_email, message.as_string())
-    smtp.quit()
\ No newline at end of file
+    return smtp
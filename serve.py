@@ -0,0 +1,71 @@
+import time
+import signal
+import logging
+import argparse
+import threading
+import _thread
+from waitress import create_server
+from main import app
+from jobs import job_queue
+from print_spooler import print_spooler
+from pipeline import shutdown_worker_pool
+from concurrency import limiter
+from startup import start_services
+
+
+class GracefulShutdown:
+    #the first signal drains: no new work, in-flight requests, generate jobs and print
+    #jobs finish and the worker pool exits; a second signal stops right away
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.stopping = False
+
+    def install(self):
+        #SIGBREAK is Ctrl+Break on the Windows booth PCs
+        for name in ["SIGINT", "SIGTERM", "SIGBREAK"]:
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), self.handle)
+
+    def handle(self, signum, frame):
+        if self.stopping:
+            raise KeyboardInterrupt
+        self.stopping = True
+        logging.info(f"Shutting down, draining for up to {self.timeout}s")
+        threading.Thread(target=self.drain, name="drain", daemon=True).start()
+
+    def drain(self):
+        deadline = time.time() + self.timeout
+        remaining = lambda: max(0, deadline - time.time())
+        try:
+            if not limiter.drain(remaining()):
+                logging.warning("Requests still running at shutdown")
+            if not job_queue.drain(remaining()):
+                logging.warning("Generate jobs still running at shutdown")
+            if not print_spooler.drain(remaining()):
+                logging.warning("Print jobs still queued at shutdown")
+            shutdown_worker_pool()
+        finally:
+            #stops the server loop through handle, stopping is already set
+            _thread.interrupt_main()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the photobooth API with waitress")
+    parser.add_argument("--host", default=app.config["SERVER_HOST"])
+    parser.add_argument("--port", type=int, default=app.config["SERVER_PORT"])
+    parser.add_argument("--threads", type=int, default=app.config["SERVER_THREADS"], help="request threads, the effects run in the worker pool")
+    args = parser.parse_args()
+    #importing the app already logged, which set the root logger up at WARNING
+    logging.basicConfig(level=logging.INFO, force=True)
+
+    #one process: jobs, print spooler, ingest sessions and manifests are shared in memory
+    server = create_server(app, host=args.host, port=args.port, threads=args.threads)
+    GracefulShutdown(app.config["SHUTDOWN_TIMEOUT"]).install()
+    start_services()
+    logging.info(f"Serving on http://{args.host}:{args.port} with {args.threads} threads")
+    server.run()
+    logging.info("Server stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import os
+import logging
+import confuse
+
+#plain settings, usable without the Flask app, e.g. by regenerate.py;
+#config.py copies them into the app config
+settings = {}
+app_config = confuse.Configuration("photobooth_py", __name__)
+
+#problems are collected per key instead of giving up at the first one, /api/health reports them
+config_errors = []
+
+#relative paths of files the app itself keeps, like the email outbox, are resolved
+#against the app directory, not whatever directory the server was started from
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+try:
+    app_config.set_file(os.environ['CONFIG_PATH'])
+except KeyError:
+    config_errors.append("CONFIG_PATH is not set")
+except confuse.ConfigError as e:
+    config_errors.append(f"{e}")
+
+
+def load(key, template=None, view=None):
+    view = app_config[key] if view is None else view
+    try:
+        settings[key] = view.get(template)
+    except confuse.ConfigError as e:
+        config_errors.append(f"{e}")
+        #a bad optional value falls back to its default, a missing required one stays missing
+        if isinstance(template, confuse.Optional):
+            settings[key] = template.default
+
+
+logging.info("Start loading configuration...")
+load("IMG_SRC_BASE_DIR")
+load("IMG_RESULT_BASE_DIR")
+load("IMG_FRAME_BASE_DIR")
+load("IMG_FRAME_ASSETS_DIR")
+load("CASCADE_CLASSIFIER_XML")
+load("EMAIL_USERNAME")
+load("EMAIL_PASSWD")
+load("AVAILABLE_EFFECT", confuse.StrSeq())
+load("AVAILABLE_8_FRAME", confuse.StrSeq())
+load("AVAILABLE_8_FRAME_ELLIPSE", confuse.StrSeq())
+load("AVAILABLE_6_FRAME", confuse.StrSeq())
+load("AVAILABLE_6_FRAME_6_TAKES", confuse.StrSeq())
+load("SMTP_SERVERNAME")
+load("SMTP_SERVERPORT", int)
+load("PRINTER_NAME")
+load("WORKER_POOL_SIZE", confuse.Optional(int, default=os.cpu_count()))
+load("JOB_WORKERS", confuse.Optional(int, default=2))
+load("FRAME_CACHE_SIZE", confuse.Optional(int, default=4))
+load("FRAME_LAYOUTS", confuse.Optional(dict, default={}))
+load("ANIMATION_FORMATS", confuse.Optional(confuse.StrSeq(), default=["gif"]))
+load("EMAIL_OUTBOX_PATH", confuse.Optional(str, default="email_outbox.db"))
+settings["EMAIL_OUTBOX_PATH"] = os.path.join(APP_DIR, settings["EMAIL_OUTBOX_PATH"])
+load("EMAIL_WORKERS", confuse.Optional(int, default=2))
+load("EMAIL_MAX_ATTEMPTS", confuse.Optional(int, default=5))
+load("EMAIL_RETRY_DELAY", confuse.Optional(int, default=5))
+load("EMAIL_ATTACHMENT_CACHE_SIZE", confuse.Optional(int, default=16))
+load("HOTFOLDER_PATH_PRINT", confuse.Optional(str, default=None))
+load("PRINTERS", confuse.Optional(dict, default={}))
+load("PRINT_DEDUP_SECONDS", confuse.Optional(int, default=60))
+load("PRINT_PRERENDER", confuse.Optional(bool, default=False))
+load("PRINT_SIZE", confuse.Optional(list, default=None), view=app_config["PRINTER_CONFIG"]["PRINT_SIZE"])
+load("FACE_AWARE_CROP", confuse.Optional(bool, default=True))
+load("FACE_DETECT_SIZE", confuse.Optional(int, default=480))
+load("MAX_CONTENT_LENGTH", confuse.Optional(int, default=256 * 1024 * 1024), view=app_config["UPLOAD_MAX_SIZE"])
+load("UPLOAD_MAX_PIXELS", confuse.Optional(int, default=50000000))
+load("INGEST_WATCH", confuse.Optional(bool, default=True))
+load("INGEST_POLL_INTERVAL", confuse.Optional(float, default=1.0))
+load("INGEST_SESSION_TTL", confuse.Optional(int, default=1800))
+load("PUBLIC_BASE_URL", confuse.Optional(str, default=None))
+load("SERVER_HOST", confuse.Optional(str, default="localhost"))
+load("SERVER_PORT", confuse.Optional(int, default=8080))
+load("SERVER_THREADS", confuse.Optional(int, default=16))
+load("CONCURRENCY_LIMITS", confuse.Optional(dict, default={}))
+load("SHUTDOWN_TIMEOUT", confuse.Optional(int, default=60))
+load("THUMBNAIL_WIDTHS", confuse.Optional(list, default=[240, 480, 960]))
+load("THUMBNAIL_QUALITY", confuse.Optional(int, default=85))
+load("INTERMEDIATE_FORMAT", confuse.Optional(confuse.Choice(["png", "jpg", "webp"]), default=None))
+load("INTERMEDIATE_QUALITY", confuse.Optional(int, default=95))
+load("STORAGE_QUOTA_MB", confuse.Optional(int, default=0))
+load("STORAGE_LOW_WATER", confuse.Optional(float, default=0.9))
+load("STORAGE_MAX_AGE_HOURS", confuse.Optional(float, default=0))
+load("STORAGE_MIN_IDLE", confuse.Optional(int, default=3600))
+load("STORAGE_EVICT_SOURCES", confuse.Optional(bool, default=False))
+load("STORAGE_SHARDED", confuse.Optional(bool, default=False))
+load("STORAGE_COMPACT_INTERVAL", confuse.Optional(int, default=600))
+load("ANIMATION_MAX_SIZE", confuse.Optional(int, default=720))
+
+if config_errors:
+    logging.error("Error loading configuration:\n" + "\n".join(config_errors))
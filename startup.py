@@ -0,0 +1,70 @@
+import time
+import logging
+import threading
+from config import config_errors
+from pipeline import start_worker_pool
+from email_queue import email_outbox
+from print_spooler import print_spooler
+from ingest import ingest_tracker
+from storage import storage
+
+
+class Warmup:
+    #everything the first session would otherwise pay for is done before /api/health
+    #reports ready. The effects only run in the pool workers, so the kernels, presets,
+    #face detector and frames are warmed there, by their initializer, not in this process
+    def __init__(self):
+        self.steps = [
+            ["worker_pool", start_worker_pool],
+        ]
+        self.status = { name: {"status": "pending"} for name, _ in self.steps }
+        self.state = "idle"
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def start(self):
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.state = "starting"
+            self.worker = threading.Thread(target=self.run, name="warmup", daemon=True)
+            self.worker.start()
+
+    def run(self):
+        start = time.perf_counter()
+        for name, step in self.steps:
+            self.status[name]["status"] = "running"
+            step_start = time.perf_counter()
+            try:
+                step()
+                self.status[name]["status"] = "done"
+            except Exception as e:
+                logging.error(f"Warm-up step {name} failed: {e}", exc_info=True)
+                self.status[name]["status"] = "failed"
+                self.status[name]["error"] = f"{e}"
+            self.status[name]["seconds"] = round(time.perf_counter() - step_start, 3)
+        failed = any(x["status"] == "failed" for x in self.status.values())
+        self.state = "failed" if failed else "ready"
+        logging.info(f"Warm-up {self.state} in {time.perf_counter() - start:.2f}s")
+
+    def ready(self):
+        return self.state == "ready" and not config_errors
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "steps": { name: dict(self.status[name]) for name, _ in self.steps },
+            "config_errors": list(config_errors),
+        }
+
+
+warmup = Warmup()
+
+
+def start_services():
+    #background workers, started by whichever entry point serves the app
+    email_outbox.start()
+    print_spooler.start()
+    ingest_tracker.start()
+    storage.start()
+    warmup.start()
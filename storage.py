@@ -0,0 +1,248 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from settings import settings
+from metrics import timed
+from manifest import MANIFEST_NAME, manifest_lock
+
+#shard directories are named _00 .. _ff, tx_ids never start with an underscore
+SHARD_PREFIX = "_"
+#compiled.jpg and the animations are what guests keep, every other result is an
+#intermediate that can be rendered again from the sources
+FINAL_PREFIX = "compiled."
+#temp dot files this old are leftovers of a crash, not writes still in progress
+STALE_TEMP_SECONDS = 3600
+
+
+def shard(tx_id):
+    return SHARD_PREFIX + hashlib.sha1(tx_id.encode()).hexdigest()[:2]
+
+
+def result_dir(tx_id):
+    #with STORAGE_SHARDED a session lives in IMG_RESULT_BASE_DIR/_xx/<tx_id>, so no
+    #directory holds more than a few hundred sessions
+    flat_path = os.path.join(settings["IMG_RESULT_BASE_DIR"], tx_id)
+    if not settings["STORAGE_SHARDED"]:
+        return flat_path
+    sharded_path = os.path.join(settings["IMG_RESULT_BASE_DIR"], shard(tx_id), tx_id)
+    #sessions from before sharding was turned on stay put until compaction moves them
+    if not os.path.isdir(sharded_path) and os.path.isdir(flat_path):
+        return flat_path
+    return sharded_path
+
+
+def source_dir(tx_id):
+    #camera software writes here directly, sources are never sharded
+    return os.path.join(settings["IMG_SRC_BASE_DIR"], tx_id)
+
+
+def is_shard(name):
+    return len(name) == len(SHARD_PREFIX) + 2 and name.startswith(SHARD_PREFIX)
+
+
+def list_sessions(base_dir):
+    #(tx_id, path) of every session, flat or sharded
+    if not os.path.isdir(base_dir):
+        return
+    for name in os.listdir(base_dir):
+        path = os.path.join(base_dir, name)
+        if not os.path.isdir(path):
+            continue
+        if is_shard(name):
+            for tx_id in os.listdir(path):
+                if os.path.isdir(os.path.join(path, tx_id)):
+                    yield tx_id, os.path.join(path, tx_id)
+        else:
+            yield name, path
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for x in files:
+            try:
+                size += os.path.getsize(os.path.join(root, x))
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def intermediate_files(path):
+    #effect captures, print.jpg and thumbnails of a session, never the final outputs
+    files = []
+    for effect in os.listdir(path):
+        effect_path = os.path.join(path, effect)
+        if not os.path.isdir(effect_path):
+            continue
+        for root, dirs, names in os.walk(effect_path):
+            files.extend(os.path.join(root, x) for x in names if root != effect_path or not x.startswith((FINAL_PREFIX, ".")))
+    return files
+
+
+class StorageManager:
+    #keeps IMG_RESULT_BASE_DIR and IMG_SRC_BASE_DIR under STORAGE_QUOTA_MB by evicting the
+    #intermediates of the least recently used sessions, and of sessions idle for longer than
+    #STORAGE_MAX_AGE_HOURS; a background task also shards old sessions and removes leftovers
+    def __init__(self, interval):
+        self.interval = interval
+        self.access = {}
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.last_compaction = None
+        self.worker = None
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self.run_worker, name="storage-compaction", daemon=True)
+            self.worker.start()
+
+    def touch(self, tx_id):
+        with self.lock:
+            self.access[tx_id] = time.time()
+
+    def last_access(self, tx_id, path):
+        #after a restart the manifest, written by every generate, stands in for the access time
+        with self.lock:
+            accessed = self.access.get(tx_id, 0)
+        try:
+            return max(accessed, os.path.getmtime(os.path.join(path, MANIFEST_NAME)))
+        except FileNotFoundError:
+            return max(accessed, os.path.getmtime(path))
+
+    def scan(self):
+        sources = { tx_id: path for tx_id, path in list_sessions(settings["IMG_SRC_BASE_DIR"]) }
+        sessions = []
+        for tx_id, path in list_sessions(settings["IMG_RESULT_BASE_DIR"]):
+            intermediates = intermediate_files(path)
+            sessions.append({
+                "tx_id": tx_id,
+                "path": path,
+                "source_path": sources.pop(tx_id, None),
+                "last_access": self.last_access(tx_id, path),
+                "result_bytes": dir_size(path),
+                "source_bytes": 0,
+                "intermediate_bytes": sum(os.path.getsize(x) for x in intermediates if os.path.exists(x)),
+            })
+        for session in sessions:
+            if session["source_path"] is not None:
+                session["source_bytes"] = dir_size(session["source_path"])
+        #sources that were never generated, e.g. a session that was abandoned
+        orphan_bytes = sum(dir_size(x) for x in sources.values())
+        return sessions, orphan_bytes
+
+    def evict(self, session):
+        freed = 0
+        with manifest_lock(session["path"]):
+            for path in intermediate_files(session["path"]):
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+        if settings["STORAGE_EVICT_SOURCES"] and session["source_path"] is not None:
+            #the compiled outputs survive, but the session can never be rendered again
+            shutil.rmtree(session["source_path"], ignore_errors=True)
+            freed += session["source_bytes"]
+        logging.info(f"Evicted {freed} bytes of {session['tx_id']} intermediates")
+        return freed
+
+    def migrate(self, session):
+        target = os.path.join(settings["IMG_RESULT_BASE_DIR"], shard(session["tx_id"]), session["tx_id"])
+        if session["path"] == target or os.path.exists(target):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with manifest_lock(session["path"]):
+            os.rename(session["path"], target)
+        session["path"] = target
+        return True
+
+    def remove_stale_temp(self, session):
+        removed = 0
+        now = time.time()
+        for session_path in [session["path"], session["source_path"]]:
+            if session_path is None:
+                continue
+            for root, dirs, files in os.walk(session_path):
+                for x in files:
+                    path = os.path.join(root, x)
+                    if x.startswith(".") and (x.endswith((".tmp", ".upload")) or ".tmp." in x) and now - os.path.getmtime(path) > STALE_TEMP_SECONDS:
+                        os.remove(path)
+                        removed += 1
+        return removed
+
+    def compact(self):
+        with self.compact_lock, timed("storage_compaction"):
+            start = time.perf_counter()
+            now = time.time()
+            sessions, orphan_bytes = self.scan()
+            used = orphan_bytes + sum(x["result_bytes"] + x["source_bytes"] for x in sessions)
+            quota = settings["STORAGE_QUOTA_MB"] * 1024 * 1024
+            max_age = settings["STORAGE_MAX_AGE_HOURS"] * 3600
+            #once over the quota, evict down to the low-water mark so it doesn't run on every pass
+            target = quota * settings["STORAGE_LOW_WATER"] if quota and used > quota else None
+
+            migrated = removed = evicted = freed = 0
+            #a session in use may have renders in flight, it is left alone
+            idle = [ x for x in sessions if now - x["last_access"] > settings["STORAGE_MIN_IDLE"] ]
+            for session in sorted(idle, key=lambda x: x["last_access"]):
+                if settings["STORAGE_SHARDED"] and self.migrate(session):
+                    migrated += 1
+                removed += self.remove_stale_temp(session)
+
+                too_old = max_age and now - session["last_access"] > max_age
+                over_quota = target is not None and used > target
+                if (too_old or over_quota) and session["intermediate_bytes"]:
+                    session_freed = self.evict(session)
+                    used -= session_freed
+                    freed += session_freed
+                    evicted += 1
+
+            if quota and used > quota:
+                logging.warning(f"Storage is over quota after eviction: {used} of {quota} bytes")
+            self.last_compaction = {
+                "finished_at": time.time(),
+                "seconds": round(time.perf_counter() - start, 3),
+                "sessions_evicted": evicted,
+                "bytes_freed": freed,
+                "sessions_migrated": migrated,
+                "temp_files_removed": removed,
+            }
+            return self.last_compaction
+
+    def usage(self):
+        sessions, orphan_bytes = self.scan()
+        result_bytes = sum(x["result_bytes"] for x in sessions)
+        source_bytes = orphan_bytes + sum(x["source_bytes"] for x in sessions)
+        disk = shutil.disk_usage(settings["IMG_RESULT_BASE_DIR"])
+        return {
+            "quota_bytes": settings["STORAGE_QUOTA_MB"] * 1024 * 1024,
+            "used_bytes": result_bytes + source_bytes,
+            "result_bytes": result_bytes,
+            "source_bytes": source_bytes,
+            "intermediate_bytes": sum(x["intermediate_bytes"] for x in sessions),
+            "sessions": len(sessions),
+            "disk_free_bytes": disk.free,
+            "disk_total_bytes": disk.total,
+            "sharded": settings["STORAGE_SHARDED"],
+            "intermediate_format": settings["INTERMEDIATE_FORMAT"],
+            "last_compaction": self.last_compaction,
+        }
+
+    def run_worker(self):
+        while True:
+            try:
+                self.compact()
+            except Exception as e:
+                logging.error(f"Storage compaction failed: {e}", exc_info=True)
+            time.sleep(self.interval)
+
+
+storage = StorageManager(settings["STORAGE_COMPACT_INTERVAL"])
@@ -0,0 +1,24 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_processing
+
+FRAME_SHAPE = (3544, 2363, 4)
+
+
+def test_compose_slots_with_fewer_captures_than_slots():
+    slots = image_processing.get_frame_slots(image_processing.FRAME_LAYOUTS["AVAILABLE_8_FRAME"], FRAME_SHAPE)
+    images = [ np.full((600, 900, 3), 200, dtype=np.uint8) for _ in range(2) ]
+
+    canvas = image_processing.compose_slots(images, slots, FRAME_SHAPE, faces=[None, None])
+
+    assert canvas.shape == (FRAME_SHAPE[0], FRAME_SHAPE[1], 3)
+    for slot in slots:
+        region = canvas[slot.y:slot.y + slot.height, slot.x:slot.x + slot.width]
+        if slot.capture < len(images):
+            assert region.all()
+        else:
+            assert not region.any()
@@ -0,0 +1,70 @@
+import os
+import shutil
+from PIL import Image, UnidentifiedImageError
+from werkzeug.utils import secure_filename
+from config import app
+
+#accepted formats with their file extensions
+UPLOAD_FORMATS = {
+    "JPEG": {"extensions": [".jpg", ".jpeg"]},
+    "PNG": {"extensions": [".png"]},
+}
+CHUNK_SIZE = 1024 * 1024
+
+
+def upload_filename(filename):
+    name = secure_filename(filename or "")
+    extensions = [ x for img_format in UPLOAD_FORMATS.values() for x in img_format["extensions"] ]
+    if not name or os.path.splitext(name)[1].lower() not in extensions:
+        raise ValueError(f"{filename} is not a {', '.join(extensions)} file")
+    #these names are pipeline outputs, list_captures would never see them
+    if name.startswith(("compiled.", "print.")):
+        raise ValueError(f"{filename} is a reserved file name")
+    return name
+
+
+def probe_image(path, filename):
+    #verify only parses the file structure, the pixel limit is checked before any decode
+    try:
+        with Image.open(path) as img:
+            img_format, (width, height) = img.format, img.size
+            img.verify()
+    except UnidentifiedImageError:
+        raise ValueError(f"{filename} is not an image")
+    except Image.DecompressionBombError as e:
+        #Pillow refuses to even open images this far over its pixel limit
+        raise ValueError(f"{filename} is too large: {e}")
+    except (OSError, SyntaxError) as e:
+        raise ValueError(f"{filename} is corrupt: {e}")
+
+    if img_format not in UPLOAD_FORMATS:
+        raise ValueError(f"{filename} is a {img_format} image, expected one of {', '.join(UPLOAD_FORMATS)}")
+    if width * height > app.config["UPLOAD_MAX_PIXELS"]:
+        raise ValueError(f"{filename} is {width}x{height}, larger than {app.config['UPLOAD_MAX_PIXELS']} pixels")
+
+    #a truncated upload only fails once its pixels are decoded, catch it now rather than at
+    #generate time. Trailer data after the image, like the MPF previews phones append, is
+    #fine. JPEGs are decoded at 1/8 scale, that still reads every scan to the end
+    try:
+        with Image.open(path) as img:
+            img.draft("RGB", (width // 8, height // 8))
+            img.load()
+    except (OSError, SyntaxError) as e:
+        raise ValueError(f"{filename} is truncated or corrupt: {e}")
+    return img_format, width, height
+
+
+def save_upload(file_storage, img_dir):
+    #streamed to a dot file in chunks and renamed once it checks out, so the
+    #pipeline never sees a partial or invalid capture
+    name = upload_filename(file_storage.filename)
+    tmp_path = os.path.join(img_dir, f".{name}.upload")
+    try:
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(file_storage.stream, f, CHUNK_SIZE)
+        probe_image(tmp_path, file_storage.filename)
+        os.replace(tmp_path, os.path.join(img_dir, name))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return name